@@ -1,8 +1,200 @@
-from azure.identity import InteractiveBrowserCredential
-from azure.keyvault.secrets import SecretClient
-import msal
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import ConnectTimeoutError
+from concurrent.futures import ThreadPoolExecutor
+from email.utils import parsedate_to_datetime
+from datetime import datetime, timezone
+from metrics import get_metrics
+from rate_limiter import RateController
 import requests
+import random
+import queue
+import threading
+import time
 import json
+import os
+
+#Base url for every Graph call, the benchmarks point it at a local stand-in
+GRAPH_URL = 'https://graph.microsoft.com/v1.0'
+#Graph JSON batching caps each envelope at 20 sub-requests
+BATCH_LIMIT = 20
+#Largest page size Graph returns for users
+MAX_PAGE_SIZE = 999
+#Graph caps the number of values in a single $filter 'in' clause
+FILTER_IN_LIMIT = 15
+#First UPN characters a partitioned directory scan gives their own range, anything else falls in a catch-all range
+SCAN_PARTITIONS = 'abcdefghijklmnopqrstuvwxyz0123456789'
+#Methods that can be resent without repeating their effect. PATCH only sets properties, so resending it is harmless
+IDEMPOTENT_METHODS = ('GET', 'HEAD', 'OPTIONS', 'PUT', 'PATCH', 'DELETE')
+#Properties shown when checking for duplicate users
+DUPLICATE_FIELDS = 'displayName,givenName,surname,userPrincipalName,employeeId,mail,businessPhones,mobilePhone,department,jobTitle,officeLocation,companyName'
+
+class GraphSession(requests.Session):
+    """requests Session shared by every Graph call. Keeps connections alive in a pool
+    and retries throttled or unavailable responses, honoring Retry-After. Writes such as creating a user
+    are only retried when Graph can't have applied them: on 429, or when the connection was never made
+
+    Args:
+        pool_size (int): number of keep-alive connections to hold per host
+        max_retries (int): how many times to retry a request before giving up
+        backoff (float): base delay in seconds for exponential backoff
+        retry_statuses (tuple[int]): status codes that should be retried
+        adaptive (bool): pace requests with an adaptive limiter per endpoint class, tuned by throttling and latency
+    """
+    def __init__(self, pool_size=10, max_retries=5, backoff=1.0, retry_statuses=(429, 503, 504), adaptive=False):
+        super().__init__()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.mount('https://', adapter)
+        self.mount('http://', adapter)
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.retry_statuses = retry_statuses
+        self.retries = 0
+        self._lock = threading.Lock()
+        self.rate_controller = RateController(max_concurrency=pool_size) if adaptive else None
+
+    def request(self, method, url, *args, **kwargs):
+        limiter = self.rate_controller.limiter(method, url) if self.rate_controller else None
+        attempt = 0
+        while True:
+            if limiter:
+                limiter.acquire()
+            start = time.perf_counter()
+            response = None
+            try:
+                response = super().request(method, url, *args, **kwargs)
+            except requests.ConnectionError as error:
+                failure = error
+            finally:
+                #every outcome hands the limiter slot back, any other exception counts as a failed connection
+                seconds = time.perf_counter() - start
+                status = response.status_code if response is not None else None
+                throttled = status in self.retry_statuses
+                get_metrics().record_http(method, url, status, seconds)
+                if limiter:
+                    limiter.release(status, seconds, retry_after(response.headers, None) if throttled else None)
+            if response is None:
+                if attempt >= self.max_retries or not (method.upper() in IDEMPOTENT_METHODS or never_sent(failure)):
+                    raise failure
+                delay = self.backoff * 2 ** attempt
+            else:
+                if not self.should_retry(method, status) or attempt >= self.max_retries:
+                    return response
+                delay = retry_after(response.headers, self.backoff * 2 ** attempt)
+                print(f"{response.status_code} from {url}, retrying in {delay:.1f}s")
+            attempt += 1
+            with self._lock:
+                self.retries += 1
+            #jitter so parallel callers don't retry in lockstep
+            time.sleep(delay + random.uniform(0, self.backoff))
+
+    def should_retry(self, method, status):
+        """Tells whether a response can be retried without repeating a write Graph may already have applied
+
+        Args:
+            method (string): HTTP method of the request or $batch sub-request
+            status (int): response status
+
+        Returns:
+            bool: True for retry statuses on idempotent methods, and for 429 on any method
+        """
+        if status not in self.retry_statuses:
+            return False
+        return status == 429 or method.upper() in IDEMPOTENT_METHODS
+
+    def stats(self):
+        """Reports retry and connection reuse counts for the session
+
+        Returns:
+            dict: counts of requests, new connections, reused connections and retries
+        """
+        requests_made = 0
+        connections = 0
+        for adapter in set(self.adapters.values()):
+            pools = adapter.poolmanager.pools
+            for key in pools.keys():
+                pool = pools[key]
+                requests_made += pool.num_requests
+                connections += pool.num_connections
+        stats = {
+            'requests': requests_made,
+            'connections': connections,
+            'connections_reused': requests_made - connections,
+            'retries': self.retries
+        }
+        if self.rate_controller:
+            stats['limits'] = self.rate_controller.stats()
+        return stats
+
+def never_sent(error):
+    """Tells whether a connection error happened before the request could reach Graph
+
+    Args:
+        error (ConnectionError): the error raised by requests
+
+    Returns:
+        bool: True if connecting timed out or was refused
+    """
+    if isinstance(error, requests.ConnectTimeout):
+        return True
+    #requests wraps the urllib3 error, refused connections are a NewConnectionError, a ConnectTimeoutError subclass
+    reason = getattr(error.args[0], 'reason', None) if error.args else None
+    return isinstance(reason, ConnectTimeoutError)
+
+def retry_after(headers, default):
+    """Reads the Retry-After header of a response or $batch sub-response, in seconds or as an HTTP date
+
+    Args:
+        headers (dict): the throttled response's headers
+        default (float): delay to use if the header is missing or unreadable
+
+    Returns:
+        float: seconds to wait before retrying
+    """
+    #sub-response headers are a plain dict, so match the name without case
+    value = next((value for key, value in (headers or {}).items() if key.lower() == 'retry-after'), None)
+    if value is None:
+        return default
+    try:
+        return max(float(value), 0)
+    except ValueError:
+        pass
+    try:
+        return max((parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds(), 0)
+    except (TypeError, ValueError):
+        return default
+
+_session = None
+
+def configure_session(**kwargs):
+    """Replaces the shared Graph session. Accepts the GraphSession arguments
+
+    Returns:
+        GraphSession: the new shared session
+    """
+    global _session
+    if _session is not None:
+        _session.close()
+    _session = GraphSession(**kwargs)
+    return _session
+
+def configure_session_from_env():
+    """Replaces the shared Graph session with one built from the pool, retry and pacing settings in the environment
+
+    Returns:
+        GraphSession: the new shared session
+    """
+    return configure_session(pool_size=int(os.getenv("GRAPH_POOL_SIZE", 10)), max_retries=int(os.getenv("GRAPH_MAX_RETRIES", 5)),
+        adaptive=os.getenv("GRAPH_ADAPTIVE", "").lower() == "true")
+
+def get_session():
+    """Returns the shared Graph session, creating it with defaults if needed
+
+    Returns:
+        GraphSession: the shared session
+    """
+    if _session is None:
+        configure_session()
+    return _session
 
 def print_json(json_data):
     """Pretty Prints json data
@@ -13,26 +205,147 @@ def print_json(json_data):
     json_formatted_str = json.dumps(json_data, indent=2)
     print(json_formatted_str)
 
-def get_vault_secret(tenant_id,vault_url,secret_name):
+def get_vault_secret(tenant_id,vault_url,secret_name,auth_record_path=None):
     """Gets a secret key from Azure Key Vault
 
     Args:
         tenant_id (string): the tenant id for the azure instance key vault is stored in
         vault_url (string): the url for azure key vault
         secret_name (string): the name for the desired secret
+        auth_record_path (string): file to keep the browser login in, so later runs sign in silently
 
     Returns:
         string: the key pulled from Azure Key Vault
     """
-    #Prompt for user login in browser
-    credential = InteractiveBrowserCredential(tenant_id=tenant_id)
+    #the Azure SDKs are slow to import, so they are only loaded when a secret is fetched
+    from azure.identity import InteractiveBrowserCredential, TokenCachePersistenceOptions, AuthenticationRecord
+    from azure.keyvault.secrets import SecretClient
+    if auth_record_path is None:
+        #Prompt for user login in browser
+        credential = InteractiveBrowserCredential(tenant_id=tenant_id)
+    else:
+        #Reuse the saved login and its persisted token cache, only prompting the first time
+        persistence = TokenCachePersistenceOptions(name='simple_gen', allow_unencrypted_storage=True)
+        record = None
+        if os.path.exists(auth_record_path):
+            with open(auth_record_path) as file:
+                record = AuthenticationRecord.deserialize(file.read())
+        credential = InteractiveBrowserCredential(tenant_id=tenant_id, cache_persistence_options=persistence, authentication_record=record)
+        if record is None:
+            record = credential.authenticate(scopes=[vault_url.rstrip('/') + '/.default'])
+            with open(auth_record_path, 'w') as file:
+                file.write(record.serialize())
     #Pull client secret from azure key vault and return it
     client = SecretClient(vault_url=vault_url, credential=credential)
     retrieved_secret = client.get_secret(secret_name)
     return retrieved_secret.value
 
+class TokenProvider:
+    """Process-wide token source for every scope the app needs. Shares one MSAL application
+    and a serialized on-disk token cache, and refreshes tokens before they expire.
+    The client secret is only loaded when a token actually has to be requested from Azure AD
+
+    Args:
+        client_id (string): Application (client) ID from Azure App Registration
+        authority (string): Authority url from the M365 Tenant
+        client_secret (string | callable): Client secret, or a function that returns it
+        cache_path (string): file to persist the MSAL token cache in, None to keep it in memory
+        refresh_margin (int): seconds before expiry at which a token is refreshed
+    """
+    def __init__(self, client_id, authority, client_secret, cache_path=None, refresh_margin=300):
+        self.client_id = client_id
+        self.authority = authority
+        self.cache_path = cache_path
+        self.refresh_margin = refresh_margin
+        self._client_secret = client_secret
+        self._app = None
+        self._tokens = {}
+        self._lock = threading.Lock()
+        import msal
+        self.cache = msal.SerializableTokenCache()
+        if cache_path and os.path.exists(cache_path):
+            with open(cache_path) as file:
+                self.cache.deserialize(file.read())
+
+    def _application(self):
+        import msal
+        if self._app is None:
+            if callable(self._client_secret):
+                self._client_secret = self._client_secret()
+            self._app = msal.ConfidentialClientApplication(self.client_id, authority=self.authority,
+                client_credential=self._client_secret, token_cache=self.cache)
+        return self._app
+
+    def _save_cache(self):
+        if self.cache_path and self.cache.has_state_changed:
+            #the cache holds live tokens, keep it readable by this user only
+            descriptor = os.open(self.cache_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            with os.fdopen(descriptor, 'w') as file:
+                file.write(self.cache.serialize())
+            self.cache.has_state_changed = False
+
+    def get_token(self, scope):
+        """Gets an access token, from memory or the token cache when it is still fresh
+
+        Args:
+            scope (list[string]): scopes for the token
+
+        Returns:
+            string: the access token
+        """
+        import msal
+        key = ' '.join(sorted(scope))
+        with self._lock:
+            now = time.time()
+            token, expires_on = self._tokens.get(key, (None, 0))
+            if expires_on - now > self.refresh_margin:
+                return token
+
+            #Look in the persisted cache before touching the application or the secret
+            stale = []
+            for entry in self.cache.search(msal.TokenCache.CredentialType.ACCESS_TOKEN, target=scope, query={'client_id': self.client_id}):
+                if int(entry['expires_on']) - now > self.refresh_margin:
+                    self._tokens[key] = (entry['secret'], int(entry['expires_on']))
+                    print('Access token was loaded from cache')
+                    return entry['secret']
+                stale.append(entry)
+            #drop tokens that are about to expire so MSAL requests a new one
+            for entry in stale:
+                self.cache.remove_at(entry)
+
+            token_result = self._application().acquire_token_for_client(scopes=scope)
+            if 'access_token' not in token_result:
+                raise Exception(f"Could not acquire token: {token_result.get('error_description')}")
+            print('New access token was acquired from Azure AD')
+            self._tokens[key] = (token_result['access_token'], now + int(token_result['expires_in']))
+            self._save_cache()
+            return token_result['access_token']
+
+_token_provider = None
+
+def configure_token_provider(client_id, authority, client_secret, **kwargs):
+    """Replaces the shared token provider. Accepts the TokenProvider arguments
+
+    Returns:
+        TokenProvider: the new shared provider
+    """
+    global _token_provider
+    _token_provider = TokenProvider(client_id, authority, client_secret, **kwargs)
+    return _token_provider
+
+def configure_token_provider_from_env():
+    """Replaces the shared token provider with one built from the app registration,
+    Key Vault and token cache settings in the environment
+
+    Returns:
+        TokenProvider: the new shared provider
+    """
+    #The vault secret is only fetched if no cached token is fresh enough
+    load_secret = lambda: get_vault_secret(tenant_id=os.getenv("TENANT_ID"), vault_url=os.getenv("VAULT_URL"),secret_name=os.getenv("VAULT_SECRET_NAME"),auth_record_path=os.getenv("AUTH_RECORD_PATH"))
+    return configure_token_provider(os.getenv("CLIENT_ID"), os.getenv("AUTHORITY"), load_secret, cache_path=os.getenv("TOKEN_CACHE_PATH"))
+
 def get_access_token(client_id, authority, client_secret, scope):
-    """Gets an access token for the MS Graph API
+    """Gets an access token for the MS Graph API, through the shared TokenProvider
 
     Args:
         client_id (string): Application (client) ID from Azure App Registration
@@ -43,21 +356,9 @@ def get_access_token(client_id, authority, client_secret, scope):
     Returns:
         string: returns access token for MS Graph API
     """
-    client = msal.ConfidentialClientApplication(client_id, authority=authority, client_credential=client_secret)
-    token_result = client.acquire_token_silent(scope, account=None)
-    
-    # If the token is available in cache, save it to a variable
-    if token_result:
-        access_token = token_result['access_token']
-        print('Access token was loaded from cache')
-
-    # If the token is not available in cache, acquire a new one from Azure AD and save it to a variable
-    if not token_result:
-        token_result = client.acquire_token_for_client(scopes=scope)
-        access_token = token_result['access_token']
-        print('New access token was acquired from Azure AD')
-
-    return access_token
+    if _token_provider is None or _token_provider.client_id != client_id or _token_provider.authority != authority:
+        configure_token_provider(client_id, authority, client_secret)
+    return _token_provider.get_token(scope)
 
 def paginate_json(data, headers, response_data):
     """Paginates Json API responses until hitting the end. Adds them to list response_data
@@ -69,10 +370,54 @@ def paginate_json(data, headers, response_data):
     """
     while "@odata.nextLink" in data:
         next_link = data["@odata.nextLink"]
-        graph_result = requests.get(next_link, headers=headers)
+        graph_result = get_session().get(next_link, headers=headers)
         data = graph_result.json()
         response_data.extend(data["value"])
 
+def iter_graph(access_token, url, params=None, select=None, top=None, prefetch=True, headers=None):
+    """Lazily yields every item in a Graph collection, one page at a time.
+    While a page is being consumed the next one is already being fetched
+
+    Args:
+        access_token (string): access token for the MS Graph API
+        url (string): url of the collection
+        params (dict): extra query parameters, such as $filter
+        select (string): comma separated properties to return ($select)
+        top (int): page size ($top), at most 999
+        prefetch (bool): fetch the next page in the background
+        headers (dict): extra request headers, such as ConsistencyLevel
+
+    Yields:
+        json: the next item in the collection
+    """
+    headers = {
+        'Authorization': access_token,
+        **(headers or {})
+    }
+    params = dict(params or {})
+    if select:
+        params['$select'] = select
+    if top:
+        params['$top'] = min(top, MAX_PAGE_SIZE)
+
+    def fetch(page_url, page_params):
+        graph_result = get_session().get(page_url, headers=headers, params=page_params)
+        graph_result.raise_for_status()
+        return graph_result.json()
+
+    #the nextLink already carries the query, so params only go on the first request
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        page = executor.submit(fetch, url, params)
+        while page is not None:
+            data = page.result()
+            next_link = data.get("@odata.nextLink")
+            page = None
+            if next_link and prefetch:
+                page = executor.submit(fetch, next_link, None)
+            yield from data["value"]
+            if next_link and not prefetch:
+                page = executor.submit(fetch, next_link, None)
+
 def patch_user(access_token, userPrincipalName, **kwargs):
     """Issues a PATCH request to update user properties in Azure AD
     For Valid PATCH arguments check API Reference: https://learn.microsoft.com/en-us/graph/api/user-update?view=graph-rest-1.0&tabs=http
@@ -82,7 +427,7 @@ def patch_user(access_token, userPrincipalName, **kwargs):
         userPrincipalName (string): UPN for the user to be patched
     """
     #MS Graph REST API url
-    url = 'https://graph.microsoft.com/v1.0/users/' + userPrincipalName
+    url = GRAPH_URL + '/users/' + userPrincipalName
     #Headers for API call (access token)
     headers = {
         'Authorization': access_token
@@ -92,32 +437,44 @@ def patch_user(access_token, userPrincipalName, **kwargs):
     for key, value in kwargs.items():
         body[key] = value
     #Issue HTTP PATCH request to update user info
-    temp = requests.patch(url,headers=headers,json=body)
+    temp = get_session().patch(url,headers=headers,json=body)
     print(temp)
 
-def create_user(access_token, userPrincipalName, password, **kwargs):
-    #MS Graph REST API url
-    url = 'https://graph.microsoft.com/v1.0/users/'
-    #Headers for API call (access token)
-    headers = {
-        'Authorization': access_token
-    }
+def build_user_body(userPrincipalName, password, **kwargs):
+    """Builds the request body for creating a user
+
+    Args:
+        userPrincipalName (string): UPN for the new user
+        password (string): initial password for the new user
+
+    Returns:
+        dict: request body for the Graph create user call
+    """
     #init request body from kwargs key value pairs
     body = {}
     body['userPrincipalName'] = userPrincipalName
     body['usageLocation'] = 'US'
-    my_pass = password
     body['passwordProfile'] = {
         "forceChangePasswordNextSignIn": False,
-        "password": my_pass
+        "password": password
     }
     
     #assign values from args
     for key, value in kwargs.items():
         body[key] = value
+    return body
+
+def create_user(access_token, userPrincipalName, password, **kwargs):
+    #MS Graph REST API url
+    url = GRAPH_URL + '/users/'
+    #Headers for API call (access token)
+    headers = {
+        'Authorization': access_token
+    }
+    body = build_user_body(userPrincipalName, password, **kwargs)
     print_json(body)
     #Issue HTTP PATCH request to update user info
-    temp = requests.post(url,headers=headers,json=body)
+    temp = get_session().post(url,headers=headers,json=body)
     print(temp.content)
     return temp.content
 
@@ -129,18 +486,18 @@ def set_manager(access_token, user_upn, manager_upn):
         userPrincipalName (string): UPN for the user to be patched
         manager_id (string): The id of the user's manager
     """
-    url = 'https://graph.microsoft.com/v1.0/users/' + user_upn + '/manager/$ref'
+    url = GRAPH_URL + '/users/' + user_upn + '/manager/$ref'
     headers = {
         'Authorization': access_token
     }
     body = {
-        "@odata.id": "https://graph.microsoft.com/v1.0/users/" + manager_upn
+        "@odata.id": GRAPH_URL + "/users/" + manager_upn
     }
-    temp = requests.put(url,headers=headers,json=body)
+    temp = get_session().put(url,headers=headers,json=body)
     print(temp)
 
 def assign_license(access_token, userPrincipalName, license_sku_id):
-    url = f'https://graph.microsoft.com/v1.0/users/{userPrincipalName}/assignlicense'
+    url = f'{GRAPH_URL}/users/{userPrincipalName}/assignlicense'
     print(url)
     headers = {
         'Authorization': access_token
@@ -153,48 +510,449 @@ def assign_license(access_token, userPrincipalName, license_sku_id):
         ],
         "removeLicenses": []
     }
-    temp = requests.post(url,headers=headers,json=body)
+    temp = get_session().post(url,headers=headers,json=body)
     print(temp)
 
-def get_user_prefixes(access_token):
-    """queries the Graph API and generates a Pandas Dataframe of all employees UPN's and Directory Id's
+def get_subscribed_skus(access_token):
+    """Gets the license SKUs the tenant has subscribed to, with their seat counts
 
     Args:
         access_token (string): access token for the MS Graph API
+
+    Returns:
+        list[dict]: skus with skuId, skuPartNumber, prepaidUnits and consumedUnits
     """
-    url = 'https://graph.microsoft.com/v1.0/users?$select=userprincipalname'
+    url = GRAPH_URL + '/subscribedSkus'
+    return list(iter_graph(access_token, url, prefetch=False))
+
+def user_exists(access_token, userPrincipalName):
+    """Checks whether a user exists in the directory
+
+    Args:
+        access_token (string): access token for the MS Graph API
+        userPrincipalName (string): UPN to look up
+
+    Returns:
+        bool: True if the user exists
+    """
+    url = GRAPH_URL + '/users/' + userPrincipalName
     headers = {
         'Authorization': access_token
     }
-    
-    response_data = []
-    
-    # Make a GET request to the provided url, passing the access token in a header
-    graph_result = requests.get(url=url, headers=headers)
-    data = graph_result.json()
-    response_data.extend(data["value"])
+    temp = get_session().get(url, headers=headers, params={'$select': 'id'})
+    if temp.status_code == 404:
+        return False
+    temp.raise_for_status()
+    return True
 
-    paginate_json(data,headers,response_data)
+def create_user_request(request_id, userPrincipalName, password, **kwargs):
+    """Builds a $batch sub-request that creates a user
 
-    #convert to list of userPrincipalNames
-    upn_list = [item['userPrincipalName'] for item in response_data]
+    Args:
+        request_id (string): id for the sub-request, unique within the batch
+        userPrincipalName (string): UPN for the new user
+        password (string): initial password for the new user
 
-    trimmed_upns = [email.split('@')[0] for email in upn_list]
+    Returns:
+        dict: $batch sub-request
+    """
+    return {
+        'id': request_id,
+        'method': 'POST',
+        'url': '/users',
+        'headers': {'Content-Type': 'application/json'},
+        'body': build_user_body(userPrincipalName, password, **kwargs)
+    }
 
-    return trimmed_upns
+def set_manager_request(request_id, user_upn, manager_upn, depends_on=None):
+    """Builds a $batch sub-request that sets a users manager
 
-def get_users_by_name(access_token,firstName,lastName):
-    url = f"https://graph.microsoft.com/v1.0/users?$filter=(givenName eq '{firstName}' and surName eq '{lastName}')&$select=displayName,userPrincipalName,employeeId,mail,businessPhones,mobilePhone,department,jobTitle,officeLocation,companyName"
+    Args:
+        request_id (string): id for the sub-request, unique within the batch
+        user_upn (string): UPN for the user to be updated
+        manager_upn (string): UPN for the user's manager
+        depends_on (list[string]): ids of sub-requests that must succeed first
+
+    Returns:
+        dict: $batch sub-request
+    """
+    sub_request = {
+        'id': request_id,
+        'method': 'PUT',
+        'url': f'/users/{user_upn}/manager/$ref',
+        'headers': {'Content-Type': 'application/json'},
+        'body': {"@odata.id": GRAPH_URL + "/users/" + manager_upn}
+    }
+    if depends_on:
+        sub_request['dependsOn'] = depends_on
+    return sub_request
+
+def patch_user_request(request_id, user_id, **kwargs):
+    """Builds a $batch sub-request that updates user properties
+
+    Args:
+        request_id (string): id for the sub-request, unique within the batch
+        user_id (string): id or UPN of the user to be patched
+
+    Returns:
+        dict: $batch sub-request
+    """
+    return {
+        'id': request_id,
+        'method': 'PATCH',
+        'url': f'/users/{user_id}',
+        'headers': {'Content-Type': 'application/json'},
+        'body': dict(kwargs)
+    }
+
+def assign_license_request(request_id, userPrincipalName, license_sku_id, depends_on=None):
+    """Builds a $batch sub-request that assigns a license to a user
+
+    Args:
+        request_id (string): id for the sub-request, unique within the batch
+        userPrincipalName (string): UPN for the user to be licensed
+        license_sku_id (string): sku id of the license to assign
+        depends_on (list[string]): ids of sub-requests that must succeed first
+
+    Returns:
+        dict: $batch sub-request
+    """
+    sub_request = {
+        'id': request_id,
+        'method': 'POST',
+        'url': f'/users/{userPrincipalName}/assignLicense',
+        'headers': {'Content-Type': 'application/json'},
+        'body': {"addLicenses": [{"skuId": license_sku_id}], "removeLicenses": []}
+    }
+    if depends_on:
+        sub_request['dependsOn'] = depends_on
+    return sub_request
+
+def send_batch(access_token, sub_requests):
+    """Sends a single $batch envelope of up to 20 sub-requests
+
+    Args:
+        access_token (string): access token for the MS Graph API
+        sub_requests (list[dict]): $batch sub-requests
+
+    Returns:
+        dict: sub-request id mapped to its response ({'status', 'body'})
+    """
     headers = {
         'Authorization': access_token
     }
-    
-    response_data = []
-    
-    # Make a GET request to the provided url, passing the access token in a header
-    graph_result = requests.get(url=url, headers=headers)
-    data = graph_result.json()
-    response_data.extend(data["value"])
+    session = get_session()
+    responses = {}
+    attempt = 0
+    while True:
+        temp = session.post(GRAPH_URL + '/$batch',headers=headers,json={'requests': sub_requests})
+        #if the envelope itself fails, every sub-request fails with its status
+        if temp.status_code != 200:
+            responses.update({item['id']: {'status': temp.status_code, 'body': temp.text} for item in sub_requests})
+            return responses
+        results = {item['id']: item for item in temp.json()['responses']}
+
+        #Sub-requests are throttled one by one, resend those and anything that failed because it depended on them.
+        #writes that came back 503 or 504 may have been applied, so they are reported rather than resent
+        retry_ids = set()
+        for item in sub_requests:
+            status = results[item['id']]['status']
+            if session.should_retry(item['method'], status) or (status == 424 and retry_ids.intersection(item.get('dependsOn', []))):
+                retry_ids.add(item['id'])
+        if not retry_ids or attempt >= session.max_retries:
+            responses.update(results)
+            return responses
+        responses.update({key: item for key, item in results.items() if key not in retry_ids})
+
+        delay = max(retry_after(results[key].get('headers'), session.backoff * 2 ** attempt) for key in retry_ids)
+        print(f"{len(retry_ids)} throttled $batch sub-requests, retrying in {delay:.1f}s")
+        if session.rate_controller:
+            session.rate_controller.limiter('POST', GRAPH_URL + '/$batch').pause(delay)
+        #dependencies that already succeeded are dropped, dependsOn may only name requests in the same envelope
+        retried = []
+        for item in sub_requests:
+            if item['id'] not in retry_ids:
+                continue
+            depends_on = [key for key in item.get('dependsOn', []) if key in retry_ids]
+            item = {key: value for key, value in item.items() if key != 'dependsOn'}
+            if depends_on:
+                item['dependsOn'] = depends_on
+            retried.append(item)
+        sub_requests = retried
+        attempt += 1
+        with session._lock:
+            session.retries += 1
+        time.sleep(delay + random.uniform(0, session.backoff))
+
+def batch_requests(access_token, request_groups, max_workers=1):
+    """Packs groups of dependent sub-requests into $batch envelopes and sends them.
+    A group is never split across envelopes, since dependsOn only applies within one batch
+
+    Args:
+        access_token (string): access token for the MS Graph API
+        request_groups (list[list[dict]]): sub-requests grouped per user
+        max_workers (int): number of envelopes to send concurrently
+
+    Returns:
+        dict: sub-request id mapped to its response ({'status', 'body'})
+    """
+    envelopes = []
+    envelope = []
+    for group in request_groups:
+        if len(envelope) + len(group) > BATCH_LIMIT:
+            envelopes.append(envelope)
+            envelope = []
+        envelope.extend(group)
+    if envelope:
+        envelopes.append(envelope)
+
+    responses = {}
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        for result in executor.map(lambda item: send_batch(access_token, item), envelopes):
+            responses.update(result)
+    return responses
+
+def batch_error(response):
+    """Pulls a readable error message out of a $batch sub-response
+
+    Args:
+        response (dict): sub-response from batch_requests
+
+    Returns:
+        string: the error message, or the status code if there is none
+    """
+    body = response.get('body')
+    if isinstance(body, dict) and 'error' in body:
+        return f"{response['status']} {body['error'].get('message', '')}"
+    return str(response['status'])
+
+def get_user_prefixes(access_token, top=999, max_workers=1):
+    """queries the Graph API for the UPN prefix of every user, one page at a time,
+    or a few pages per worker when UPN ranges are paged concurrently
+
+    Args:
+        access_token (string): access token for the MS Graph API
+        top (int): page size to request, at most 999
+        max_workers (int): UPN ranges to page through concurrently, 1 for a single chain of pages
+
+    Yields:
+        string: the part of a users UPN before the @
+    """
+    url = GRAPH_URL + '/users'
+    if max_workers > 1:
+        users = scan_users(access_token, 'userPrincipalName', max_workers=max_workers, top=top)
+    else:
+        users = iter_graph(access_token, url, select='userPrincipalName', top=top)
+    for item in users:
+        yield item['userPrincipalName'].split('@')[0]
+
+class DeltaExpired(Exception):
+    """Raised when Graph no longer accepts a saved deltaLink and a full resync is needed"""
+
+def get_user_prefix_delta(access_token, delta_link=None):
+    """Queries the Graph users delta endpoint for changed UPN prefixes.
+    Without a delta link every user in the tenant is returned
+
+    Args:
+        access_token (string): access token for the MS Graph API
+        delta_link (string): deltaLink saved from the previous sync
+
+    Raises:
+        DeltaExpired: the delta link is too old and a full sync must be run
+
+    Returns:
+        tuple[dict, string]: directory id mapped to prefix (None if removed), and the new deltaLink
+    """
+    url = delta_link or GRAPH_URL + '/users/delta?$select=userPrincipalName'
+    headers = {
+        'Authorization': access_token
+    }
+
+    changes = {}
+    while True:
+        graph_result = get_session().get(url, headers=headers)
+        if graph_result.status_code == 410:
+            raise DeltaExpired(graph_result.text)
+        data = graph_result.json()
+        for item in data["value"]:
+            if "@removed" in item:
+                changes[item['id']] = None
+            #updates only carry the UPN when it changed
+            elif 'userPrincipalName' in item:
+                changes[item['id']] = item['userPrincipalName'].split('@')[0]
+        if "@odata.nextLink" not in data:
+            return changes, data["@odata.deltaLink"]
+        url = data["@odata.nextLink"]
+
+def odata_quote(value):
+    """Quotes a string for use in an OData $filter, escaping apostrophes
+
+    Args:
+        value (string): the value to quote
+
+    Returns:
+        string: the quoted value
+    """
+    return "'" + str(value).replace("'", "''") + "'"
+
+def get_users_by_name(access_token,firstName,lastName):
+    url = GRAPH_URL + '/users'
+    params = {
+        '$filter': f"(givenName eq {odata_quote(firstName)} and surName eq {odata_quote(lastName)})"
+    }
+    return list(iter_graph(access_token, url, params=params, select=DUPLICATE_FIELDS))
+
+def get_users_by_surnames(access_token, surnames, max_workers=1):
+    """Gets every user whose surname is in a list, using batched 'in' filters
+
+    Args:
+        access_token (string): access token for the MS Graph API
+        surnames (list[string]): surnames to look up
+        max_workers (int): number of filter queries to run concurrently
+
+    Returns:
+        list[json]: matching users with the DUPLICATE_FIELDS properties
+    """
+    url = GRAPH_URL + '/users'
+    surnames = sorted(set(surnames))
+    chunks = [surnames[i:i + FILTER_IN_LIMIT] for i in range(0, len(surnames), FILTER_IN_LIMIT)]
+
+    def fetch(chunk):
+        params = {
+            '$filter': f"surname in ({','.join(odata_quote(name) for name in chunk)})"
+        }
+        return list(iter_graph(access_token, url, params=params, select=DUPLICATE_FIELDS, top=MAX_PAGE_SIZE, prefetch=False))
+
+    users = []
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        for response_data in executor.map(fetch, chunks):
+            users.extend(response_data)
+    return users
+
+def find_existing_users(access_token, userPrincipalNames, max_workers=1):
+    """Checks which UPNs belong to directory users, using batched 'in' filters
+
+    Args:
+        access_token (string): access token for the MS Graph API
+        userPrincipalNames (list[string]): UPNs to look up
+        max_workers (int): number of filter queries to run concurrently
+
+    Returns:
+        set[string]: the UPNs that exist, lowercased
+    """
+    url = GRAPH_URL + '/users'
+    userPrincipalNames = sorted(set(userPrincipalNames))
+    chunks = [userPrincipalNames[i:i + FILTER_IN_LIMIT] for i in range(0, len(userPrincipalNames), FILTER_IN_LIMIT)]
+
+    def fetch(chunk):
+        params = {
+            '$filter': f"userPrincipalName in ({','.join(odata_quote(upn) for upn in chunk)})"
+        }
+        return [user['userPrincipalName'].lower() for user in iter_graph(access_token, url, params=params, select='userPrincipalName', prefetch=False)]
+
+    found = set()
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        for response_data in executor.map(fetch, chunks):
+            found.update(response_data)
+    return found
+
+def scan_partitions(partitions=SCAN_PARTITIONS):
+    """Splits the directory into disjoint userPrincipalName ranges by first character
+
+    Args:
+        partitions (string): first characters that get a range of their own
+
+    Returns:
+        list[string]: a $filter per range, the last one matches every UPN the others don't
+    """
+    ranges = [f"startswith(userPrincipalName,{odata_quote(character)})" for character in partitions]
+    return ranges + [' and '.join('not ' + expression for expression in ranges)]
+
+def scan_users(access_token, select, max_workers=8, top=MAX_PAGE_SIZE, partitions=SCAN_PARTITIONS):
+    """Pages through every user in the tenant with one chain of pages per UPN range,
+    running the ranges concurrently so a cold start isn't bound by one page round trip at a time.
+    Pages are handed over through a queue of max_workers pages, so at most a few pages per worker
+    are held in memory whatever the size of the directory
 
-    paginate_json(data,headers,response_data)
-    return response_data
+    Args:
+        access_token (string): access token for the MS Graph API
+        select (string): comma separated properties to return
+        max_workers (int): number of ranges to page through concurrently
+        top (int): page size to request, at most 999
+        partitions (string): first characters that get a range of their own
+
+    Yields:
+        json: the next user in the directory, in the order the pages arrive
+    """
+    url = GRAPH_URL + '/users'
+    ranges = scan_partitions(partitions)
+    pages = queue.Queue(maxsize=max_workers)
+    stopped = threading.Event()
+
+    def put(item):
+        #gives up once the caller stops reading, so no worker is left blocked on a full queue
+        while not stopped.is_set():
+            try:
+                pages.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def fetch(expression):
+        params = {
+            '$filter': expression
+        }
+        headers = None
+        if expression.startswith('not '):
+            #not is an advanced query, Graph only runs it with an eventual consistency count
+            params['$count'] = 'true'
+            headers = {'ConsistencyLevel': 'eventual'}
+        try:
+            page = []
+            for user in iter_graph(access_token, url, params=params, select=select, top=top, prefetch=False, headers=headers):
+                page.append(user)
+                if len(page) >= top:
+                    if not put(page):
+                        return
+                    page = []
+            put(page)
+        except Exception as error:
+            put(error)
+        #None marks the end of a range
+        put(None)
+
+    executor = ThreadPoolExecutor(max_workers=max_workers)
+    for expression in ranges:
+        executor.submit(fetch, expression)
+    finished = 0
+    try:
+        while finished < len(ranges):
+            page = pages.get()
+            if page is None:
+                finished += 1
+            elif isinstance(page, Exception):
+                raise page
+            else:
+                yield from page
+    finally:
+        stopped.set()
+        executor.shutdown(wait=True, cancel_futures=True)
+
+def get_all_users(access_token, select=None, max_workers=1):
+    """Pages through every user in the tenant, one page at a time,
+    or a few pages per worker when UPN ranges are paged concurrently
+
+    Args:
+        access_token (string): access token for the MS Graph API
+        select (string): comma separated properties to return, defaults to DUPLICATE_FIELDS
+        max_workers (int): UPN ranges to page through concurrently, 1 for a single chain of pages
+
+    Yields:
+        json: the next user in the directory
+    """
+    url = GRAPH_URL + '/users'
+    if max_workers > 1:
+        yield from scan_users(access_token, select or DUPLICATE_FIELDS, max_workers=max_workers)
+    else:
+        yield from iter_graph(access_token, url, select=select or DUPLICATE_FIELDS, top=MAX_PAGE_SIZE)
@@ -0,0 +1,403 @@
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlsplit, parse_qs, unquote, urlencode
+from collections import Counter
+import itertools
+import threading
+import random
+import time
+import json
+import re
+import uuid
+
+#$filter clauses understood by the stand-in, all clauses are ANDed
+EQ_CLAUSE = re.compile(r"(\w+) eq '((?:[^']|'')*)'", re.IGNORECASE)
+IN_CLAUSE = re.compile(r"(\w+) in \(((?:\s*'(?:[^']|'')*'\s*,?)+)\)", re.IGNORECASE)
+STARTSWITH_CLAUSE = re.compile(r"(not )?startswith\((\w+),\s*'((?:[^']|'')*)'\)", re.IGNORECASE)
+QUOTED = re.compile(r"'((?:[^']|'')*)'")
+
+def unquote_odata(value):
+    return value.replace("''", "'")
+
+def surname_keys(expression):
+    """Finds the surnames a $filter is limited to, so the stand-in can skip a full scan
+
+    Args:
+        expression (string): the $filter value
+
+    Returns:
+        set[string]: lowercased surnames, None if the filter doesn't limit surname
+    """
+    for name, value in EQ_CLAUSE.findall(expression):
+        if name.lower() == 'surname':
+            return {unquote_odata(value).lower()}
+    for name, values in IN_CLAUSE.findall(expression):
+        if name.lower() == 'surname':
+            return {unquote_odata(value).lower() for value in QUOTED.findall(values)}
+    return None
+
+def initial_keys(expression):
+    """Finds the first UPN characters a $filter is limited to, so partitioned scans can skip a full scan
+
+    Args:
+        expression (string): the $filter value
+
+    Returns:
+        tuple[set[string], bool]: lowercased first characters and whether they are excluded rather than
+        required, None if the filter doesn't limit them
+    """
+    clauses = [(bool(negate), unquote_odata(value).lower()) for negate, name, value in STARTSWITH_CLAUSE.findall(expression)
+        if name.lower() == 'userprincipalname' and value]
+    for negate, value in clauses:
+        if not negate:
+            return {value[0]}, False
+    excluded = {value for negate, value in clauses if negate and len(value) == 1}
+    return (excluded, True) if excluded else None
+
+def parse_filter(expression):
+    """Turns a $filter expression into a list of predicates on a user
+
+    Args:
+        expression (string): the $filter value
+
+    Returns:
+        list[callable]: predicates that must all hold
+    """
+    predicates = []
+    for name, value in EQ_CLAUSE.findall(expression):
+        predicates.append(lambda user, name=name.lower(), value=unquote_odata(value).lower(): str(user.get(name, '')).lower() == value)
+    for name, values in IN_CLAUSE.findall(expression):
+        options = {unquote_odata(value).lower() for value in QUOTED.findall(values)}
+        predicates.append(lambda user, name=name.lower(), options=options: str(user.get(name, '')).lower() in options)
+    for negate, name, value in STARTSWITH_CLAUSE.findall(expression):
+        predicates.append(lambda user, name=name.lower(), value=unquote_odata(value).lower(), negate=bool(negate):
+            str(user.get(name, '')).lower().startswith(value) != negate)
+    return predicates
+
+class FakeGraph:
+    """In-process stand-in for the parts of Microsoft Graph simple_gen uses: /users with
+    $filter, $select, $top and paging, /users/delta, create, PATCH, manager $ref,
+    assignLicense, subscribedSkus and /$batch. It can add latency and inject 429s
+
+    Args:
+        latency (float): seconds to wait before answering each top level request
+        throttle_rate (float): fraction of top level requests answered with 429
+        retry_after (int): Retry-After seconds sent with injected 429s
+        page_size (int): default page size when no $top is given
+        seed (int): seed for the throttling decisions
+        rate_limit (float): requests per second the tenant allows, counting each $batch sub-request. Requests over it
+            get a 429 with Retry-After, like Graph's own throttling. None for no limit
+    """
+    def __init__(self, latency=0.0, throttle_rate=0.0, retry_after=0, page_size=100, seed=0, rate_limit=None):
+        self.latency = latency
+        self.throttle_rate = throttle_rate
+        self.retry_after = retry_after
+        self.page_size = page_size
+        self.random = random.Random(seed)
+        self.rate_limit = rate_limit
+        self.quota = rate_limit or 0
+        self.quota_time = time.monotonic()
+        self.lock = threading.Lock()
+        #lowercased upn -> user, kept in insertion order for stable paging
+        self.users = {}
+        self.ids = {}
+        self.surnames = {}
+        self.initials = {}
+        self.managers = {}
+        self.licenses = Counter()
+        self.skus = []
+        self.version = itertools.count(1)
+        self.requests = Counter()
+        self.statuses = Counter()
+        self.sub_requests = 0
+        self.throttled = 0
+        self.server = None
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server.server_port}/v1.0"
+
+    def add_user(self, userPrincipalName, **fields):
+        """Adds a user to the directory
+
+        Args:
+            userPrincipalName (string): the users UPN
+
+        Returns:
+            dict: the stored user
+        """
+        user = {'id': str(uuid.uuid4()), 'userPrincipalName': userPrincipalName, **fields}
+        with self.lock:
+            user['_version'] = next(self.version)
+            self.users[userPrincipalName.lower()] = user
+            self.ids[user['id']] = user
+            self.surnames.setdefault(str(user.get('surname', '')).lower(), []).append(user)
+            self.initials.setdefault(userPrincipalName[:1].lower(), []).append(user)
+        return user
+
+    def add_sku(self, skuPartNumber, seats, consumed=0):
+        """Adds a subscribed license SKU
+
+        Args:
+            skuPartNumber (string): the sku's part number
+            seats (int): enabled prepaid units
+            consumed (int): units already assigned
+
+        Returns:
+            dict: the stored sku
+        """
+        sku = {'skuId': str(uuid.uuid4()), 'skuPartNumber': skuPartNumber, 'prepaidUnits': {'enabled': seats}, 'consumedUnits': consumed}
+        with self.lock:
+            self.skus.append(sku)
+        return sku
+
+    def over_limit(self):
+        """Takes one request from the tenant's rate limit, call with the lock held
+
+        Returns:
+            bool: True if the request should be throttled
+        """
+        if not self.rate_limit:
+            return False
+        now = time.monotonic()
+        #a second's worth of requests can burst
+        self.quota = min(self.rate_limit, self.quota + (now - self.quota_time) * self.rate_limit)
+        self.quota_time = now
+        if self.quota < 1:
+            self.throttled += 1
+            return True
+        self.quota -= 1
+        return False
+
+    def find_user(self, key):
+        key = unquote(key)
+        return self.ids.get(key) or self.users.get(key.lower())
+
+    def reset_stats(self):
+        with self.lock:
+            self.requests.clear()
+            self.statuses.clear()
+            self.sub_requests = 0
+            self.throttled = 0
+
+    def stats(self):
+        """Reports what the stand-in has served since the last reset
+
+        Returns:
+            dict: request counts by route, status counts, sub-requests and injected 429s
+        """
+        with self.lock:
+            return {
+                'requests': sum(self.requests.values()),
+                'by_route': dict(self.requests),
+                'statuses': dict(self.statuses),
+                'sub_requests': self.sub_requests,
+                'throttled': self.throttled
+            }
+
+    def start(self):
+        """Starts serving on a free local port in a background thread
+
+        Returns:
+            FakeGraph: self, for chaining
+        """
+        graph = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def handle_any(self):
+                length = int(self.headers.get('Content-Length') or 0)
+                body = json.loads(self.rfile.read(length)) if length else None
+                status, headers, payload = graph.handle_top_level(self.command, self.path, body)
+                data = b'' if payload is None else json.dumps(payload).encode()
+                self.send_response(status)
+                for key, value in headers.items():
+                    self.send_header(key, value)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            do_GET = do_POST = do_PUT = do_PATCH = do_DELETE = handle_any
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+
+    def handle_top_level(self, method, path, body):
+        if self.latency:
+            time.sleep(self.latency)
+        route = self.route_name(method, path)
+        with self.lock:
+            self.requests[route] += 1
+            throttle = self.throttle_rate and self.random.random() < self.throttle_rate
+            #$batch envelopes aren't limited themselves, their sub-requests are
+            limited = False
+            if throttle:
+                self.throttled += 1
+            elif route != 'POST /$batch':
+                limited = self.over_limit()
+        if throttle:
+            status, headers, payload = 429, {'Retry-After': str(self.retry_after)}, {'error': {'code': 'TooManyRequests', 'message': 'Injected throttle'}}
+        elif limited:
+            status, headers, payload = 429, {'Retry-After': '1'}, {'error': {'code': 'TooManyRequests', 'message': 'Rate limit exceeded'}}
+        else:
+            status, payload = self.dispatch(method, path, body)
+            headers = {}
+        with self.lock:
+            self.statuses[status] += 1
+        return status, headers, payload
+
+    def route_name(self, method, path):
+        parts = urlsplit(path).path.split('/')[2:]
+        if not parts or parts[0] != 'users':
+            return f"{method} /{'/'.join(parts[:1])}"
+        if len(parts) == 1 or parts[1] == 'delta':
+            return f"{method} /users" + ('/delta' if len(parts) > 1 else '')
+        return f"{method} /users/{{id}}" + ''.join('/' + part for part in parts[2:])
+
+    def dispatch(self, method, path, body):
+        split = urlsplit(path)
+        parts = [part for part in split.path.split('/') if part][1:]
+        query = {key: values[0] for key, values in parse_qs(split.query).items()}
+        match (method, parts):
+            case ('POST', ['$batch']):
+                return self.batch(body)
+            case ('GET', ['subscribedSkus']):
+                return 200, {'value': self.skus}
+            case ('GET', ['users', 'delta']):
+                return self.delta(query)
+            case ('GET', ['users']):
+                return self.list_users(query)
+            case ('POST', ['users']):
+                return self.create_user(body)
+            case ('GET', ['users', key]):
+                user = self.find_user(key)
+                return (200, self.project(user, query.get('$select'))) if user else self.not_found()
+            case ('PATCH', ['users', key]):
+                return self.patch_user(key, body)
+            case ('PUT', ['users', key, 'manager', '$ref']):
+                return self.set_manager(key, body)
+            case ('POST', ['users', key, action]) if action.lower() == 'assignlicense':
+                return self.assign_license(key, body)
+        return 400, {'error': {'code': 'BadRequest', 'message': f'Unsupported {method} {split.path}'}}
+
+    def not_found(self):
+        return 404, {'error': {'code': 'Request_ResourceNotFound', 'message': 'Resource does not exist'}}
+
+    def project(self, user, select):
+        if not select:
+            return {key: value for key, value in user.items() if not key.startswith('_')}
+        fields = {field.lower() for field in select.split(',')}
+        return {key: value for key, value in user.items() if key.lower() in fields or key == 'id'}
+
+    def list_users(self, query):
+        expression = query.get('$filter', '')
+        predicates = parse_filter(expression)
+        top = int(query.get('$top', self.page_size))
+        skip = int(query.get('$skiptoken', 0))
+        surnames = surname_keys(expression)
+        initials = initial_keys(expression)
+        with self.lock:
+            if surnames is not None:
+                users = [user for surname in sorted(surnames) for user in self.surnames.get(surname, [])]
+            elif initials is not None:
+                characters, excluded = initials
+                users = [user for key, group in self.initials.items() if (key in characters) != excluded for user in group]
+            else:
+                users = list(self.users.values())
+        if predicates:
+            matches = [user for user in users if all(predicate({key.lower(): value for key, value in user.items()}) for predicate in predicates)]
+        else:
+            matches = users
+        page = matches[skip:skip + top]
+        result = {'value': [self.project(user, query.get('$select')) for user in page]}
+        if skip + top < len(matches):
+            next_query = {**query, '$skiptoken': skip + top}
+            result['@odata.nextLink'] = f"{self.url}/users?" + urlencode(next_query)
+        return 200, result
+
+    def delta(self, query):
+        since = int(query.get('$deltatoken', 0))
+        skip = int(query.get('$skiptoken', 0))
+        with self.lock:
+            changed = [user for user in self.users.values() if user['_version'] > since]
+            latest = max((user['_version'] for user in self.users.values()), default=0)
+        page = changed[skip:skip + self.page_size]
+        result = {'value': [self.project(user, query.get('$select')) for user in page]}
+        if skip + self.page_size < len(changed):
+            result['@odata.nextLink'] = f"{self.url}/users/delta?$deltatoken={since}&$skiptoken={skip + self.page_size}"
+        else:
+            result['@odata.deltaLink'] = f"{self.url}/users/delta?$deltatoken={latest}"
+        return 200, result
+
+    def create_user(self, body):
+        upn = body.get('userPrincipalName', '')
+        if not upn or upn.lower() in self.users:
+            return 400, {'error': {'code': 'Request_BadRequest', 'message': 'Another object with the same value for property userPrincipalName already exists.'}}
+        fields = {key: value for key, value in body.items() if key not in ('userPrincipalName', 'passwordProfile')}
+        return 201, self.project(self.add_user(upn, **fields), None)
+
+    def patch_user(self, key, body):
+        user = self.find_user(key)
+        if user is None:
+            return self.not_found()
+        with self.lock:
+            user.update(body or {})
+            user['_version'] = next(self.version)
+        return 204, None
+
+    def set_manager(self, key, body):
+        user = self.find_user(key)
+        manager = self.find_user(body.get('@odata.id', '').rsplit('/', 1)[-1]) if body else None
+        if user is None or manager is None:
+            return self.not_found()
+        with self.lock:
+            self.managers[user['id']] = manager['id']
+        return 204, None
+
+    def assign_license(self, key, body):
+        user = self.find_user(key)
+        if user is None:
+            return self.not_found()
+        with self.lock:
+            for license in body.get('addLicenses', []):
+                sku = next((sku for sku in self.skus if sku['skuId'] == license['skuId']), None)
+                if sku is not None:
+                    if sku['consumedUnits'] >= sku['prepaidUnits']['enabled']:
+                        return 400, {'error': {'code': 'Request_BadRequest', 'message': 'License assignment failed because service plans are not available.'}}
+                    sku['consumedUnits'] += 1
+                self.licenses[license['skuId']] += 1
+        return 200, self.project(user, None)
+
+    def batch(self, body):
+        sub_requests = body.get('requests', [])
+        if len(sub_requests) > 20:
+            return 400, {'error': {'code': 'BadRequest', 'message': 'Batch request limit is 20'}}
+        with self.lock:
+            self.sub_requests += len(sub_requests)
+        statuses = {}
+        responses = []
+        for sub_request in sub_requests:
+            headers = {}
+            if any(statuses.get(dependency, 424) >= 400 for dependency in sub_request.get('dependsOn', [])):
+                status, payload = 424, {'error': {'code': 'FailedDependency', 'message': 'Dependent request failed'}}
+            else:
+                with self.lock:
+                    limited = self.over_limit()
+                if limited:
+                    status, headers, payload = 429, {'Retry-After': '1'}, {'error': {'code': 'TooManyRequests', 'message': 'Rate limit exceeded'}}
+                else:
+                    status, payload = self.dispatch(sub_request['method'], '/v1.0' + sub_request['url'], sub_request.get('body'))
+            statuses[sub_request['id']] = status
+            responses.append({'id': sub_request['id'], 'status': status, 'headers': headers, 'body': payload})
+        return 200, {'responses': responses}
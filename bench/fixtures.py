@@ -0,0 +1,157 @@
+from prefix_index import PrefixIndex
+from db import sqlite_connect
+import pandas as pd
+import random
+import os
+
+FIRST_NAMES = ['James', 'Mary', 'John', 'Patricia', 'Robert', 'Jennifer', 'Michael', 'Linda', 'William', 'Elizabeth',
+    'David', 'Barbara', 'Richard', 'Susan', 'Joseph', 'Jessica', 'Thomas', 'Sarah', 'Charles', 'Karen',
+    'Daniel', 'Nancy', 'Matthew', 'Lisa', 'Anthony', 'Betty', 'Mark', 'Sandra', 'Steven', 'Ashley']
+LAST_NAMES = ['Smith', 'Johnson', 'Williams', 'Brown', 'Jones', 'Garcia', 'Miller', 'Davis', 'Rodriguez', 'Martinez',
+    'Hernandez', 'Lopez', 'Gonzalez', 'Wilson', 'Anderson', 'Thomas', 'Taylor', 'Moore', 'Jackson', 'Martin',
+    'Lee', 'Perez', 'Thompson', 'White', 'Harris', 'Sanchez', 'Clark', "O'Brien", 'Lewis', 'Robinson']
+LICENSE_SKUS = ['SPE_E3', 'SPE_F1']
+DEPARTMENTS = ['Customer Service', 'Sales', 'Finance', 'Operations', 'Engineering', 'Human Resources', 'Marketing', 'Legal']
+
+def random_name(rng):
+    #a long tail of surnames keeps collisions realistic as the directory grows
+    last_name = rng.choice(LAST_NAMES)
+    if rng.random() < 0.5:
+        last_name += str(rng.randrange(1000)).translate(str.maketrans('0123456789', 'abcdefghij'))
+    return rng.choice(FIRST_NAMES), last_name
+
+def build_reference_tables(size, rng):
+    """Builds the Companies, Departments, Locations, Location_Domains and License_Skus tables for a tenant size
+
+    Args:
+        size (int): number of directory users the tenant is modelled on
+        rng (Random): random source
+
+    Returns:
+        dict: table name mapped to its DataFrame
+    """
+    company_count = max(size // 1000, 2)
+    location_count = max(size // 100, 5)
+    companies = pd.DataFrame({
+        'Abbreviation': [f"C{i:04d}" for i in range(company_count)],
+        'Name': [f"Company {i}" for i in range(company_count)],
+        'Domain': [f"company{i}.example.com" for i in range(company_count)]
+    })
+    locations = pd.DataFrame({
+        'Location Code': [f"L{i:05d}" for i in range(location_count)],
+        'Office': [f"Office {i}" for i in range(location_count)],
+        'Address': [f"{i} Main St" for i in range(location_count)],
+        'City': [rng.choice(['Denver', 'Austin', 'Boston', 'Tampa']) for _ in range(location_count)],
+        'Country': ['US'] * location_count,
+        'State': [rng.choice(['CO', 'TX', 'MA', 'FL']) for _ in range(location_count)],
+        'Zip': [rng.randrange(10000, 99999) for _ in range(location_count)]
+    })
+    #the first company gets its mail domain from the location
+    location_domains = pd.DataFrame({
+        'Company Abbreviation': [companies['Abbreviation'][0]] * location_count,
+        'Location Code': locations['Location Code'],
+        'Domain': [f"office{i}.company0.example.com" for i in range(location_count)]
+    })
+    departments = pd.DataFrame({'Name': DEPARTMENTS})
+    #E3 for every company, with the field heavy departments on F1
+    license_skus = pd.DataFrame({
+        'Company Abbreviation': [None, None, *companies['Abbreviation']],
+        'Department': ['Customer Service', 'Operations', *[None] * company_count],
+        'Sku Part Number': ['SPE_F1', 'SPE_F1', *['SPE_E3'] * company_count]
+    })
+    return {
+        'Companies': companies,
+        'Departments': departments,
+        'Locations': locations,
+        'Location_Domains': location_domains,
+        'License_Skus': license_skus
+    }
+
+def build_directory(size, rng):
+    """Builds the existing directory users, with prefixes allocated the same way simple_gen does
+
+    Args:
+        size (int): number of directory users
+        rng (Random): random source
+
+    Returns:
+        list[dict]: users with userPrincipalName, givenName and surname
+    """
+    prefixes = PrefixIndex()
+    users = []
+    for _ in range(size):
+        first_name, last_name = random_name(rng)
+        prefix = prefixes.next_prefix(first_name, last_name)
+        prefixes.add(prefix)
+        users.append({'userPrincipalName': prefix + '@championsgh.com', 'givenName': first_name, 'surname': last_name,
+            'displayName': f"{first_name} {last_name}"})
+    return users
+
+def build_new_hires(count, tables, directory, rng, manager_rate=0.5, new_manager_rate=0.2):
+    """Builds a users file for the onboarding run
+
+    Args:
+        count (int): number of new hires
+        tables (dict): reference tables from build_reference_tables
+        directory (list[dict]): existing directory users, used as managers
+        rng (Random): random source
+        manager_rate (float): fraction of new hires with a manager
+        new_manager_rate (float): fraction of those whose manager is a new hire further down the file
+
+    Returns:
+        DataFrame: rows in the users.csv layout
+    """
+    rows = []
+    companies = tables['Companies']['Abbreviation'].tolist()
+    locations = tables['Locations']['Location Code'].tolist()
+    for i in range(count):
+        first_name, last_name = random_name(rng)
+        manager = rng.choice(directory)['userPrincipalName'] if directory and rng.random() < manager_rate else None
+        #managers who are new hires are referenced by employee id, always later rows so there are no cycles
+        if manager and i < count - 1 and rng.random() < new_manager_rate:
+            manager = str(100000 + rng.randrange(i + 1, count))
+        rows.append({
+            'lastName': last_name,
+            'firstName': first_name,
+            'displayName': f"{first_name} {last_name}",
+            'officeOrField': rng.choice(['Office', 'Field']),
+            'officePhone': f"555{rng.randrange(1000000):07d}",
+            'mobilePhone': None,
+            'locationCode': rng.choice(locations),
+            'companyAbbreviation': rng.choice(companies),
+            'department': rng.choice(DEPARTMENTS),
+            'jobTitle': 'Analyst',
+            'employeeId': str(100000 + i),
+            'manager': manager
+        })
+    return pd.DataFrame(rows)
+
+def write_fixtures(directory_path, size, hires, seed=0):
+    """Writes a SQLite database and users file for one benchmark size
+
+    Args:
+        directory_path (string): folder to write users.db and users.csv into
+        size (int): rows in Existing_Prefixes and users in the directory
+        hires (int): number of rows in users.csv
+        seed (int): random seed
+
+    Returns:
+        tuple[string, string, list[dict]]: database path, users file path and the directory users
+    """
+    rng = random.Random(seed)
+    os.makedirs(directory_path, exist_ok=True)
+    db_path = os.path.join(directory_path, f"bench_{size}.db")
+    users_path = os.path.join(directory_path, f"users_{size}.csv")
+    if os.path.exists(db_path):
+        os.remove(db_path)
+
+    tables = build_reference_tables(size, rng)
+    directory = build_directory(size, rng)
+    tables['Existing_Prefixes'] = pd.DataFrame({'Prefix': [user['userPrincipalName'].split('@')[0] for user in directory]})
+    engine = sqlite_connect(db_path)
+    for name, table in tables.items():
+        table.to_sql(name, engine, index=False)
+    engine.dispose()
+
+    build_new_hires(hires, tables, directory, rng).to_csv(users_path, index=False)
+    return db_path, users_path, directory
@@ -0,0 +1,137 @@
+from bench.fake_graph import FakeGraph
+from bench.fixtures import write_fixtures
+from contextlib import contextmanager, redirect_stdout
+from db import sqlite_connect
+from prefix_index import PrefixIndex
+from sql_queries import ensure_prefix_index, load_existing_prefixes, loads_prefixes_by_stem, load_license_skus
+from reference_cache import load_reference_data
+from user_input import read_user_scope
+from metrics import reset_metrics
+from simple_gen import iter_users
+from bench.fixtures import LICENSE_SKUS
+import api_tools
+import os
+import argparse
+import tempfile
+import time
+import json
+import io
+
+@contextmanager
+def phase(phases, name):
+    """Times a block and adds it to phases[name] in seconds"""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        phases[name] = phases.get(name, 0) + time.perf_counter() - start
+
+def run_size(size, options, work_dir):
+    """Runs one onboarding against the local Graph stand-in and a generated SQLite database
+
+    Args:
+        size (int): rows in Existing_Prefixes and users in the directory
+        options (Namespace): parsed command line options
+        work_dir (string): folder for the generated fixtures
+
+    Returns:
+        dict: throughput, HTTP calls and phase timings for the run
+    """
+    db_path, users_path, directory = write_fixtures(work_dir, size, options.hires, seed=options.seed)
+    graph = FakeGraph(latency=options.latency, throttle_rate=options.throttle, seed=options.seed, rate_limit=options.rate_limit).start()
+    for user in directory:
+        graph.add_user(**user)
+    if options.seats is not None:
+        for part_number in LICENSE_SKUS:
+            graph.add_sku(part_number, options.seats)
+    api_tools.GRAPH_URL = graph.url
+    api_tools.configure_session(pool_size=options.workers, backoff=0.05, adaptive=options.adaptive)
+    access_token = 'Bearer bench'
+    conn = sqlite_connect(db_path)
+    metrics = reset_metrics()
+    phases = {}
+    try:
+        with phase(phases, 'db_load'):
+            reference = load_reference_data(conn, scope=read_user_scope(users_path, options.chunk_size))
+            if options.seats is not None:
+                reference['License_Skus'] = load_license_skus(conn)
+
+        with phase(phases, 'prefix_load'):
+            ensure_prefix_index(conn)
+            prefixes = PrefixIndex([] if loads_prefixes_by_stem(conn) else load_existing_prefixes(conn))
+            prefixes.update(api_tools.get_user_prefixes(access_token, max_workers=1 if options.sequential_scan else options.workers))
+        startup = graph.stats()
+        graph.reset_stats()
+
+        #the same validation, license, onboarding and manager phases as a real run.
+        #new hires share names with the directory, so every potential duplicate is accepted
+        with phase(phases, 'onboard'), redirect_stdout(io.StringIO()):
+            outcome = iter_users(access_token, users_path, os.path.join(work_dir, 'passwords.csv'), prefixes, conn,
+                max_workers=options.workers, chunk_size=options.chunk_size, assign_licenses=options.seats is not None,
+                reference=reference, confirm=lambda question: True)
+        if outcome['invalid'] or outcome['error']:
+            raise Exception(f"Generated users file was rejected: {outcome['invalid'][:5] or outcome['error']}")
+        onboarding = graph.stats()
+    finally:
+        graph.stop()
+        conn.dispose()
+
+    onboard_time = phases['onboard']
+    return {
+        'size': size,
+        'hires': options.hires,
+        'created': len(outcome['created']),
+        'licensed': sum(graph.licenses.values()),
+        'managers_linked': len(graph.managers),
+        'users_per_second': options.hires / onboard_time if onboard_time else None,
+        'http_calls_per_user': onboarding['requests'] / options.hires,
+        'sub_requests_per_user': onboarding['sub_requests'] / options.hires,
+        'startup_http_calls': startup['requests'],
+        'throttled': startup['throttled'] + onboarding['throttled'],
+        'session': api_tools.get_session().stats(),
+        'phases': phases,
+        'onboard_spans': metrics.to_dict()['spans'],
+        'http': metrics.to_dict()['http'],
+        'by_route': onboarding['by_route']
+    }
+
+def print_result(result):
+    phases = ', '.join(f"{name} {seconds:.2f}s" for name, seconds in result['phases'].items())
+    print(f"size {result['size']:>7}: {result['users_per_second']:8.1f} users/s, "
+        f"{result['http_calls_per_user']:.2f} HTTP calls/user ({result['sub_requests_per_user']:.2f} batched), "
+        f"{result['startup_http_calls']} startup calls, {result['throttled']} throttled, "
+        f"{result['created']}/{result['hires']} created")
+    print(f"{'':>14}{phases}")
+    for name, limits in result['session'].get('limits', {}).items():
+        print(f"{'':>14}{name}: sustained {limits['sustained_rate']} requests/s, concurrency {limits['concurrency']} "
+            f"(peak {limits['peak_concurrency']}), {limits['throttled']} throttled")
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline onboarding benchmark against a local Graph stand-in")
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000, 100000], help="directory and Existing_Prefixes sizes")
+    parser.add_argument('--hires', type=int, default=200, help="rows in the generated users file")
+    parser.add_argument('--workers', type=int, default=8, help="concurrent Graph calls")
+    parser.add_argument('--chunk-size', type=int, default=500, help="users file chunk size")
+    parser.add_argument('--latency', type=float, default=0.0, help="seconds of latency added to each request")
+    parser.add_argument('--throttle', type=float, default=0.0, help="fraction of requests answered with 429")
+    parser.add_argument('--rate-limit', type=float, help="requests per second the stand-in tenant allows")
+    parser.add_argument('--adaptive', action='store_true', help="pace requests with the adaptive limiter")
+    parser.add_argument('--sequential-scan', action='store_true', help="page the directory as one chain instead of concurrent UPN ranges")
+    parser.add_argument('--seats', type=int, help="assign licenses, with this many seats per sku")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--json', help="write the results to this file")
+    options = parser.parse_args()
+
+    results = []
+    with tempfile.TemporaryDirectory() as work_dir:
+        for size in options.sizes:
+            result = run_size(size, options, work_dir)
+            print_result(result)
+            results.append(result)
+
+    if options.json:
+        with open(options.json, 'w') as file:
+            json.dump(results, file, indent=2)
+
+if __name__ == '__main__':
+    main()
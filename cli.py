@@ -0,0 +1,108 @@
+import argparse
+import dotenv
+import os
+
+#Each command imports what it needs when it runs, so starting the cli and --help stay fast
+
+def graph_token():
+    """Configures the Graph session and gets a Graph access token from the settings in the environment
+
+    Returns:
+        string: the bearer access token
+    """
+    from api_tools import configure_session_from_env, configure_token_provider_from_env
+    configure_session_from_env()
+    tokens = configure_token_provider_from_env()
+    return 'Bearer ' + tokens.get_token([os.getenv("SCOPE")])
+
+def onboard(options):
+    import simple_gen
+    simple_gen.run()
+
+def check_duplicates(options):
+    """Lists the directory users that may be the same person as each row of the users file, without creating anyone"""
+    from name_index import build_name_index
+    from user_input import read_user_chunks
+    from simple_gen import onboard_options_from_env
+    access_token = graph_token()
+    onboard_options = onboard_options_from_env()
+    fuzzy_threshold = onboard_options['fuzzy_threshold']
+    max_workers = onboard_options['max_workers']
+
+    #a full scan or fuzzy matching pulls the whole directory once, otherwise each chunk filters by surname
+    name_index = None
+    if onboard_options['full_scan'] or fuzzy_threshold is not None:
+        name_index = build_name_index(access_token, [], full_scan=True, fuzzy_threshold=fuzzy_threshold, max_workers=max_workers)
+    found = 0
+    for user_df in read_user_chunks(os.getenv("USER_PATH"), onboard_options['chunk_size']):
+        names = list(zip(user_df['firstName'], user_df['lastName']))
+        chunk_index = name_index or build_name_index(access_token, names, max_workers=max_workers)
+        for index, (first_name, last_name) in zip(user_df.index, names):
+            potential_dupes = chunk_index.find(first_name, last_name)
+            if potential_dupes:
+                found += 1
+                upns = ', '.join(user['userPrincipalName'] for user in potential_dupes)
+                print(f"Row {index}: {first_name} {last_name} may already exist as {upns}")
+    print(f"{found} users with potential duplicates")
+
+def sync_prefixes(options):
+    """Brings the local prefix snapshot up to date without onboarding anyone"""
+    from directory_sync import sync_user_prefixes
+    if not os.getenv("PREFIX_SNAPSHOT_PATH"):
+        raise Exception("PREFIX_SNAPSHOT_PATH is not set")
+    sync_user_prefixes(graph_token(), os.getenv("PREFIX_SNAPSHOT_PATH"))
+
+def worker(options):
+    """Onboards users files dropped into WORKER_DROP_DIR, keeping tokens, the database pool and caches warm between jobs"""
+    import simple_gen
+    from worker import Worker
+    tokens, _, conn = simple_gen.connect()
+    service = Worker(os.getenv("WORKER_DROP_DIR"), lambda: 'Bearer ' + tokens.get_token([os.getenv("SCOPE")]), conn,
+        prefix_snapshot_path=os.getenv("PREFIX_SNAPSHOT_PATH"),
+        reference_cache_dir=os.getenv("REFERENCE_CACHE_DIR"),
+        reference_ttl=int(os.getenv("REFERENCE_CACHE_TTL", 3600)),
+        onboard_options=simple_gen.onboard_options_from_env())
+    service.start()
+    service.run_forever(float(os.getenv("WORKER_POLL_SECONDS", 5)))
+
+def reconcile(options):
+    """Updates the address of every user whose office details changed in the Locations table.
+    Company fields are left alone, only the office address is reconciled"""
+    import simple_gen
+    from sql_queries import load_locations
+    from reconcile import reconcile_users
+    _, access_token, conn = simple_gen.connect()
+    #read Locations straight from the database, the snapshot could still hold the rows that were just edited
+    reconcile_users(access_token, load_locations(conn), dry_run=options.dry_run, max_workers=simple_gen.onboard_options_from_env()['max_workers'])
+
+def check_connection(options):
+    import test
+    test.test()
+
+COMMANDS = {
+    'onboard': (onboard, "create the users in the users file (default)"),
+    'check-duplicates': (check_duplicates, "list possible duplicates for the users file without creating anyone"),
+    'sync-prefixes': (sync_prefixes, "update the local prefix snapshot from Graph"),
+    'worker': (worker, "onboard users files as they are dropped into WORKER_DROP_DIR"),
+    'reconcile': (reconcile, "update user addresses that no longer match their office in the Locations table (company fields are not changed)"),
+    'check-connection': (check_connection, "check the Graph and database connections")
+}
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='simple_gen', description="M365 user onboarding")
+    parser.add_argument('--env', help="settings file to load instead of .env")
+    parser.add_argument('--users', help="users file, overrides USER_PATH")
+    subparsers = parser.add_subparsers(dest='command')
+    for name, (_, help_text) in COMMANDS.items():
+        subparsers.add_parser(name, help=help_text)
+    subparsers.choices['reconcile'].add_argument('--dry-run', action='store_true', help="print the changes without sending them")
+    options = parser.parse_args(argv)
+
+    dotenv.load_dotenv(options.env)
+    if options.users:
+        os.environ['USER_PATH'] = options.users
+    command, _ = COMMANDS[options.command or 'onboard']
+    command(options)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,94 @@
+import os
+import struct
+
+#pyodbc connection attribute for passing an Azure AD access token
+SQL_COPT_SS_ACCESS_TOKEN = 1256
+
+def pad_token(access_token):
+    """Pads MSAL access token for compatibility with MS SQL Server in Azure.
+    Further explanation of this issue can be found here.
+    https://github.com/AzureAD/azure-activedirectory-library-for-python/wiki/Connect-to-Azure-SQL-Database
+    https://github.com/mkleehammer/pyodbc/issues/228
+
+    Args:
+        access_token (string): Access Token returned by MSAL
+
+    Returns:
+        bytes: Byte packed access token
+    """
+    #Convert Token to Bytes
+    tokenb = bytes(access_token, "UTF-8")
+    #Follow every byte with a zero byte
+    exptoken = bytearray(2 * len(tokenb))
+    exptoken[0::2] = tokenb
+    tokenstruct = struct.pack("=i", len(exptoken)) + bytes(exptoken)
+    return tokenstruct
+
+def az_db_connect(driver,server,database,token_source,pool_size=5,pool_recycle=1800):
+    """Creates a pooled engine for an Azure SQL database. Every new pooled connection
+    is opened with a fresh access token, so the pool keeps working after tokens expire
+
+    Args:
+        driver (String): String describing the ODBC Driver to use for the connection
+        server (String): url and port for the SQL Server
+        database (database): Name of the Database to access on the SQL Server
+        token_source (callable | string): function returning an access token for the sql server, or a token
+        pool_size (int): number of connections kept open in the pool
+        pool_recycle (int): seconds before a pooled connection is replaced
+
+    Returns:
+        Engine: SQLAlchemy engine backed by the connection pool
+    """
+    #only Azure needs the ODBC driver, so sqlite setups don't have to install it
+    import pyodbc
+    from sqlalchemy import create_engine
+    if isinstance(token_source, str):
+        token = token_source
+        token_source = lambda: token
+    #Build ODBC connection string
+    azure_conn_str = (
+    f"Driver={driver};"
+    f"Server={server};"
+    f"Database={database};"
+    )
+
+    def connect():
+        #Pad Token for compatibility
+        padded_token = pad_token(token_source())
+        return pyodbc.connect(azure_conn_str, attrs_before = { SQL_COPT_SS_ACCESS_TOKEN:padded_token })
+
+    return create_engine('mssql+pyodbc://', creator=connect, pool_size=pool_size, pool_recycle=pool_recycle, pool_pre_ping=True, fast_executemany=True)
+
+def sqlite_connect(db_path):
+    """Creates an engine for a local sqlite database
+
+    Args:
+        db_path (string): path to the sqlite database file
+
+    Returns:
+        Engine: SQLAlchemy engine for the database
+    """
+    from sqlalchemy import create_engine
+    return create_engine(f"sqlite:///{db_path}")
+
+def db_connect(token_source):
+    """ Establishes a connection pool to a database described in the environment
+
+    Args:
+        token_source (callable | string): function returning an access token for the database, or a token
+
+    Raises:
+        Exception: Throws an exception if the Database type is invalid
+
+    Returns:
+        Engine: SQLAlchemy engine for the database
+    """
+    mode = os.getenv("DB_MODE")
+    match mode:
+        case "SQLITE":
+            return sqlite_connect(os.getenv("DB_PATH"))
+        case "AZURE":
+            return az_db_connect(os.getenv("DB_DRIVER"),os.getenv("DB_SERVER"),os.getenv("DB_DATABASE"),token_source,
+                pool_size=int(os.getenv("DB_POOL_SIZE", 5)))
+        case _:
+            raise Exception("Invalid Database Mode")
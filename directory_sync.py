@@ -0,0 +1,60 @@
+from api_tools import get_user_prefix_delta, DeltaExpired
+import json
+import os
+
+def load_snapshot(snapshot_path):
+    """Loads the local snapshot of directory prefixes
+
+    Args:
+        snapshot_path (string): path to the snapshot json file
+
+    Returns:
+        dict: {'deltaLink': string or None, 'users': {directory id: prefix}}
+    """
+    if not os.path.exists(snapshot_path):
+        return {'deltaLink': None, 'users': {}}
+    with open(snapshot_path) as file:
+        return json.load(file)
+
+def save_snapshot(snapshot_path, snapshot):
+    """Writes the snapshot of directory prefixes, replacing the old file in one step
+
+    Args:
+        snapshot_path (string): path to the snapshot json file
+        snapshot (dict): snapshot returned by load_snapshot
+    """
+    temp_path = snapshot_path + '.tmp'
+    with open(temp_path, 'w') as file:
+        json.dump(snapshot, file)
+    os.replace(temp_path, snapshot_path)
+
+def sync_user_prefixes(access_token, snapshot_path):
+    """Brings the local prefix snapshot up to date with a Graph delta query.
+    The first run pulls every user, later runs only pull accounts changed since the saved deltaLink
+
+    Args:
+        access_token (string): access token for the MS Graph API
+        snapshot_path (string): path to the snapshot json file
+
+    Returns:
+        list[string]: prefixes of every user in the directory
+    """
+    snapshot = load_snapshot(snapshot_path)
+    try:
+        changes, delta_link = get_user_prefix_delta(access_token, snapshot['deltaLink'])
+    except DeltaExpired:
+        print("Saved deltaLink expired, running a full directory sync")
+        snapshot = {'deltaLink': None, 'users': {}}
+        changes, delta_link = get_user_prefix_delta(access_token)
+
+    users = snapshot['users']
+    for user_id, prefix in changes.items():
+        if prefix is None:
+            users.pop(user_id, None)
+        else:
+            users[user_id] = prefix
+    snapshot['deltaLink'] = delta_link
+    save_snapshot(snapshot_path, snapshot)
+    print(f"Directory sync: {len(changes)} changed accounts, {len(users)} total")
+
+    return list(users.values())
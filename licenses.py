@@ -0,0 +1,99 @@
+from api_tools import get_subscribed_skus
+from collections import Counter
+import threading
+import pandas as pd
+
+class LicenseShortage(Exception):
+    """Raised when the tenant doesn't have enough free seats for the users about to be licensed"""
+
+def resolve_skus(user_df, license_df):
+    """Picks the license SKU for each user from the License_Skus table. A row for the user's company
+    and department wins over a company wide row (no Department), which wins over a department wide one
+
+    Args:
+        user_df (DataFrame): users read from the users file
+        license_df (DataFrame): License_Skus table (Company Abbreviation, Department, Sku Part Number)
+
+    Returns:
+        list: the sku part number for each user, None if no rule applies
+    """
+    rules = {}
+    for company, department, sku in license_df[['Company Abbreviation', 'Department', 'Sku Part Number']].itertuples(index=False):
+        company = None if pd.isna(company) else company
+        department = None if pd.isna(department) else department
+        rules.setdefault((company, department), sku)
+    skus = []
+    for company, department in zip(user_df['companyAbbreviation'], user_df['department']):
+        company = None if pd.isna(company) else company
+        department = None if pd.isna(department) else department
+        skus.append(rules.get((company, department)) or rules.get((company, None)) or rules.get((None, department)))
+    return skus
+
+class SkuPool:
+    """Free seat counts for the tenant's subscribed SKUs, read once and kept up to date locally
+    as seats are taken, so a run doesn't ask Graph before every assignment
+
+    Args:
+        skus (list[dict]): subscribedSkus from get_subscribed_skus
+    """
+    def __init__(self, skus):
+        self._lock = threading.Lock()
+        self.sku_ids = {sku['skuPartNumber'].lower(): sku['skuId'] for sku in skus}
+        self.available = Counter({sku['skuPartNumber'].lower(): sku['prepaidUnits']['enabled'] - sku['consumedUnits'] for sku in skus})
+
+    def __contains__(self, part_number):
+        return part_number.lower() in self.sku_ids
+
+    def sku_id(self, part_number):
+        return self.sku_ids[part_number.lower()]
+
+    def shortages(self, demand):
+        """Compares seats needed against the free seats
+
+        Args:
+            demand (Counter): sku part number mapped to the number of seats needed
+
+        Returns:
+            dict: sku part number mapped to (needed, free) for every sku without enough seats
+        """
+        with self._lock:
+            return self._shortages(demand)
+
+    def _shortages(self, demand):
+        return {part_number: (count, self.available[part_number.lower()]) for part_number, count in demand.items()
+            if count > self.available[part_number.lower()]}
+
+    def reserve(self, demand):
+        """Takes seats for a batch of users. Nothing is taken unless every sku has enough free seats
+
+        Args:
+            demand (Counter): sku part number mapped to the number of seats needed
+
+        Raises:
+            LicenseShortage: if any sku doesn't have enough free seats
+        """
+        with self._lock:
+            short = self._shortages(demand)
+            if short:
+                raise LicenseShortage(shortage_message(short))
+            for part_number, count in demand.items():
+                self.available[part_number.lower()] -= count
+
+    def release(self, part_number, count=1):
+        """Gives back seats that were reserved but not assigned"""
+        with self._lock:
+            self.available[part_number.lower()] += count
+
+def shortage_message(short):
+    return 'Not enough licenses: ' + ', '.join(f"{part_number} needs {needed}, {free} free" for part_number, (needed, free) in short.items())
+
+def load_sku_pool(access_token):
+    """Reads the tenant's subscribed SKUs once for the run
+
+    Args:
+        access_token (string): access token for the MS Graph API
+
+    Returns:
+        SkuPool: the free seat counts
+    """
+    return SkuPool(get_subscribed_skus(access_token))
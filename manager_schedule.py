@@ -0,0 +1,99 @@
+class ManagerSchedule:
+    """Dependency graph of the users in a file and their managers. A manager is either the UPN
+    of an existing directory user, or the employeeId of a new hire further up or down the same file.
+    Users are ordered into levels so every manager comes before their reports"""
+    def __init__(self):
+        #user key -> row number, employee id and manager reference
+        self.rows = {}
+        #lowercased employee id -> user key
+        self.employees = {}
+
+    def add(self, index, key, employee_id, manager):
+        """Adds a row of the users file
+
+        Args:
+            index (int): row number in the users file
+            key (string): the row's journal key
+            employee_id (string): the row's employeeId, None if it has none
+            manager (string): manager UPN or employeeId, None if the row has no manager
+        """
+        self.rows[key] = {'index': index, 'manager': manager}
+        if employee_id:
+            self.employees[employee_id.lower()] = key
+
+    def manager_key(self, key):
+        """Finds the row of a user's manager when the manager is a new hire
+
+        Args:
+            key (string): the user key
+
+        Returns:
+            string: the manager's user key, None if the manager isn't in the file
+        """
+        manager = self.rows[key]['manager']
+        return self.employees.get(manager.lower()) if manager else None
+
+    def external_managers(self):
+        """Gets the managers that have to already exist in the directory
+
+        Returns:
+            set[string]: lowercased UPNs of managers outside the file
+        """
+        return {row['manager'].lower() for key, row in self.rows.items()
+            if row['manager'] and '@' in row['manager'] and self.manager_key(key) is None}
+
+    def levels(self):
+        """Orders the users so managers come first, every user in a level only depends on earlier levels
+
+        Returns:
+            tuple[list[list[string]], list[string]]: user keys per level, and the users that are left
+            out because they sit in or under a manager cycle
+        """
+        reports = {}
+        waiting = {}
+        for key in self.rows:
+            manager_key = self.manager_key(key)
+            waiting[key] = 0 if manager_key is None else 1
+            if manager_key is not None:
+                reports.setdefault(manager_key, []).append(key)
+
+        levels = []
+        level = [key for key, count in waiting.items() if count == 0]
+        while level:
+            levels.append(level)
+            next_level = []
+            for key in level:
+                for report in reports.get(key, []):
+                    waiting[report] -= 1
+                    if waiting[report] == 0:
+                        next_level.append(report)
+            level = next_level
+        return levels, [key for key, count in waiting.items() if count > 0]
+
+    def problems(self, existing_managers):
+        """Checks for managers that can't be linked, before anything is written
+
+        Args:
+            existing_managers (set[string]): lowercased UPNs of external managers found in the directory
+
+        Returns:
+            list[tuple[int, string]]: (row, message) for each unknown manager or manager cycle
+        """
+        problems = []
+        for key, row in self.rows.items():
+            manager = row['manager']
+            if manager and self.manager_key(key) is None and manager.lower() not in existing_managers:
+                problems.append((row['index'], f"Unknown Manager {manager}"))
+
+        _, blocked = self.levels()
+        for key in blocked:
+            #walk up the chain, rows that get back to themselves are in the cycle, the rest report into it
+            manager_key = self.manager_key(key)
+            for _ in range(len(blocked)):
+                if manager_key == key:
+                    problems.append((self.rows[key]['index'], 'Manager Cycle'))
+                    break
+                manager_key = self.manager_key(manager_key)
+            else:
+                problems.append((self.rows[key]['index'], 'Reports Into Manager Cycle'))
+        return sorted(problems)
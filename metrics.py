@@ -0,0 +1,178 @@
+from contextlib import contextmanager
+from urllib.parse import urlsplit
+import cProfile
+import threading
+import time
+import json
+import re
+
+#Upper bounds in seconds for the HTTP latency histograms
+LATENCY_BUCKETS = [0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10]
+#Path segments that name one object, collapsed so endpoints group together
+OBJECT_SEGMENT = re.compile(r'^(users|groups|subscribedSkus)$', re.IGNORECASE)
+
+def endpoint_name(method, url):
+    """Groups a request url into an endpoint, e.g. 'PUT /users/{id}/manager/$ref'
+
+    Args:
+        method (string): HTTP method
+        url (string): full request url
+
+    Returns:
+        string: the method and path with object ids replaced by {id}
+    """
+    parts = [part for part in urlsplit(url).path.split('/') if part]
+    #drop the api version
+    if parts and parts[0] in ('v1.0', 'beta'):
+        parts = parts[1:]
+    for i in range(1, len(parts)):
+        if OBJECT_SEGMENT.match(parts[i - 1]) and parts[i] != 'delta':
+            parts[i] = '{id}'
+    return f"{method.upper()} /{'/'.join(parts)}"
+
+class Metrics:
+    """Collects timing spans for the phases of a run and latency, status and throttle counts
+    for every Graph endpoint. Safe to record into from worker threads"""
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.spans = {}
+        self.http = {}
+
+    @contextmanager
+    def span(self, name, items=1):
+        """Times a block of work as one occurrence of a phase
+
+        Args:
+            name (string): the phase name
+            items (int): number of users or rows the block handled
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record_span(name, time.perf_counter() - start, items)
+
+    def record_span(self, name, seconds, items=1):
+        with self._lock:
+            span = self.spans.setdefault(name, {'count': 0, 'items': 0, 'total_seconds': 0.0, 'max_seconds': 0.0})
+            span['count'] += 1
+            span['items'] += items
+            span['total_seconds'] += seconds
+            span['max_seconds'] = max(span['max_seconds'], seconds)
+
+    def record_http(self, method, url, status, seconds):
+        """Records one HTTP attempt, retries are recorded separately
+
+        Args:
+            method (string): HTTP method
+            url (string): request url
+            status (int): response status, None if the connection failed
+            seconds (float): time until the response arrived
+        """
+        endpoint = endpoint_name(method, url)
+        with self._lock:
+            stats = self.http.setdefault(endpoint, {'count': 0, 'total_seconds': 0.0, 'throttled': 0,
+                'statuses': {}, 'buckets': [0] * (len(LATENCY_BUCKETS) + 1)})
+            stats['count'] += 1
+            stats['total_seconds'] += seconds
+            key = str(status)
+            stats['statuses'][key] = stats['statuses'].get(key, 0) + 1
+            if status == 429:
+                stats['throttled'] += 1
+            bucket = next((i for i, bound in enumerate(LATENCY_BUCKETS) if seconds <= bound), len(LATENCY_BUCKETS))
+            stats['buckets'][bucket] += 1
+
+    def to_dict(self):
+        with self._lock:
+            return json.loads(json.dumps({'spans': self.spans, 'http': self.http, 'latency_buckets': LATENCY_BUCKETS}))
+
+    def to_prometheus(self):
+        """Formats the metrics in the Prometheus text exposition format
+
+        Returns:
+            string: the metrics text
+        """
+        data = self.to_dict()
+        lines = ['# TYPE simple_gen_phase_seconds summary']
+        for name, span in data['spans'].items():
+            lines.append(f'simple_gen_phase_seconds_sum{{phase="{name}"}} {span["total_seconds"]}')
+            lines.append(f'simple_gen_phase_seconds_count{{phase="{name}"}} {span["count"]}')
+        lines.append('# TYPE simple_gen_phase_items_total counter')
+        for name, span in data['spans'].items():
+            lines.append(f'simple_gen_phase_items_total{{phase="{name}"}} {span["items"]}')
+        lines.append('# TYPE simple_gen_http_request_seconds histogram')
+        for endpoint, stats in data['http'].items():
+            cumulative = 0
+            for bound, count in zip(LATENCY_BUCKETS + ['+Inf'], stats['buckets']):
+                cumulative += count
+                lines.append(f'simple_gen_http_request_seconds_bucket{{endpoint="{endpoint}",le="{bound}"}} {cumulative}')
+            lines.append(f'simple_gen_http_request_seconds_sum{{endpoint="{endpoint}"}} {stats["total_seconds"]}')
+            lines.append(f'simple_gen_http_request_seconds_count{{endpoint="{endpoint}"}} {stats["count"]}')
+        lines.append('# TYPE simple_gen_http_responses_total counter')
+        for endpoint, stats in data['http'].items():
+            for status, count in stats['statuses'].items():
+                lines.append(f'simple_gen_http_responses_total{{endpoint="{endpoint}",status="{status}"}} {count}')
+        lines.append('# TYPE simple_gen_http_throttled_total counter')
+        for endpoint, stats in data['http'].items():
+            lines.append(f'simple_gen_http_throttled_total{{endpoint="{endpoint}"}} {stats["throttled"]}')
+        return '\n'.join(lines) + '\n'
+
+    def write(self, path):
+        """Writes the metrics to a file, Prometheus text for .prom/.txt files and json otherwise
+
+        Args:
+            path (string): the output file
+        """
+        if path.lower().endswith(('.prom', '.txt')):
+            content = self.to_prometheus()
+        else:
+            content = json.dumps(self.to_dict(), indent=2)
+        with open(path, 'w') as file:
+            file.write(content)
+
+    def summary(self):
+        """Formats the phase timings as one line per phase
+
+        Returns:
+            string: the summary
+        """
+        data = self.to_dict()
+        return '\n'.join(f"{name}: {span['total_seconds']:.2f}s over {span['items']} items" for name, span in data['spans'].items())
+
+_metrics = Metrics()
+
+def get_metrics():
+    """Returns the process-wide metrics collector
+
+    Returns:
+        Metrics: the shared collector
+    """
+    return _metrics
+
+def reset_metrics():
+    """Replaces the process-wide metrics collector with an empty one
+
+    Returns:
+        Metrics: the new collector
+    """
+    global _metrics
+    _metrics = Metrics()
+    return _metrics
+
+@contextmanager
+def profiled(profile_path=None):
+    """Runs a block under cProfile and dumps the stats to a file, when a path is given
+
+    Args:
+        profile_path (string): file for the pstats output, None to skip profiling
+    """
+    if not profile_path:
+        yield
+        return
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        profiler.dump_stats(profile_path)
@@ -0,0 +1,125 @@
+from api_tools import get_users_by_surnames, get_all_users
+from difflib import SequenceMatcher
+import unicodedata
+
+#Soundex digit for each consonant, vowels and h/w/y are dropped
+SOUNDEX_CODES = {letter: str(code) for code, letters in enumerate(['bfpv', 'cgjkqsxz', 'dt', 'l', 'mn', 'r'], start=1) for letter in letters}
+
+def normalize_name(name):
+    """Normalizes a name for comparison: lowercase, no accents, apostrophes or extra whitespace
+
+    Args:
+        name (string): the name to normalize
+
+    Returns:
+        string: the normalized name
+    """
+    name = unicodedata.normalize('NFKD', str(name or ''))
+    name = ''.join(char for char in name if not unicodedata.combining(char))
+    name = name.replace("'", '').replace('’', '')
+    return ' '.join(name.lower().split())
+
+def soundex(name):
+    """Builds the 4 character Soundex code for a normalized name
+
+    Args:
+        name (string): a normalized name
+
+    Returns:
+        string: the Soundex code, empty if the name has no letters
+    """
+    letters = [char for char in name if char.isalpha()]
+    if not letters:
+        return ''
+    code = letters[0]
+    last = SOUNDEX_CODES.get(letters[0], '')
+    for char in letters[1:]:
+        digit = SOUNDEX_CODES.get(char, '')
+        if digit and digit != last:
+            code += digit
+        #h and w don't separate repeated codes, vowels do
+        if char not in 'hw':
+            last = digit
+    return (code + '000')[:4]
+
+def blocking_key(given_name, surname):
+    """Groups names that could be fuzzy matches: surname Soundex plus first initial
+
+    Args:
+        given_name (string): normalized given name
+        surname (string): normalized surname
+
+    Returns:
+        string: the blocking key
+    """
+    return soundex(surname) + given_name[:1]
+
+class NameIndex:
+    """In-memory index of directory users by normalized (givenName, surname),
+    with an optional fuzzy lookup limited to users sharing a blocking key
+
+    Args:
+        users (iterable[json]): Graph users with givenName and surname
+        fuzzy_threshold (float): similarity ratio for fuzzy matches, None for exact only
+    """
+    def __init__(self, users=(), fuzzy_threshold=None):
+        self.fuzzy_threshold = fuzzy_threshold
+        self._exact = {}
+        self._blocks = {}
+        for user in users:
+            self.add(user)
+
+    def add(self, user):
+        """Adds a Graph user to the index
+
+        Args:
+            user (json): Graph user with givenName and surname
+        """
+        given_name = normalize_name(user.get('givenName'))
+        surname = normalize_name(user.get('surname'))
+        if not given_name and not surname:
+            return
+        self._exact.setdefault((given_name, surname), []).append(user)
+        if self.fuzzy_threshold is not None:
+            self._blocks.setdefault(blocking_key(given_name, surname), []).append((given_name + ' ' + surname, user))
+
+    def find(self, first_name, last_name):
+        """Finds users that may be the same person
+
+        Args:
+            first_name (string): the new user's first name
+            last_name (string): the new user's last name
+
+        Returns:
+            list[json]: potential duplicates, exact matches first
+        """
+        given_name = normalize_name(first_name)
+        surname = normalize_name(last_name)
+        matches = list(self._exact.get((given_name, surname), []))
+        if self.fuzzy_threshold is None:
+            return matches
+        full_name = given_name + ' ' + surname
+        for candidate, user in self._blocks.get(blocking_key(given_name, surname), []):
+            if candidate != full_name and SequenceMatcher(None, full_name, candidate).ratio() >= self.fuzzy_threshold:
+                matches.append(user)
+        return matches
+
+def build_name_index(access_token, names, full_scan=False, fuzzy_threshold=None, max_workers=1):
+    """Builds a NameIndex for a batch of new users from Graph
+
+    Args:
+        access_token (string): access token for the MS Graph API
+        names (list[tuple[string, string]]): (first name, last name) of every new user
+        full_scan (bool): pull the whole directory instead of filtering by surname
+        fuzzy_threshold (float): similarity ratio for fuzzy matches, None for exact only
+        max_workers (int): number of filter queries, or directory ranges for a full scan, to run concurrently
+
+    Returns:
+        NameIndex: index of the directory users that could match the batch
+    """
+    if full_scan or fuzzy_threshold is not None:
+        #fuzzy matches can have a different surname, so they need the whole directory
+        users = get_all_users(access_token, max_workers=max_workers)
+    else:
+        users = get_users_by_surnames(access_token, [last_name for _, last_name in names], max_workers=max_workers)
+    return NameIndex(users, fuzzy_threshold=fuzzy_threshold)
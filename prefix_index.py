@@ -0,0 +1,122 @@
+import re
+
+#a prefix is a stem followed by an optional numeric suffix without leading zeros
+SUFFIX_PATTERN = re.compile(r'^(.*?)([1-9]\d*)?$')
+
+def prefix_stems(first_name, last_name):
+    """Builds the 3 prefix conventions in order of preference:
+    first initial last name, first name last initial, first name last name
+
+    Args:
+        first_name (String): Users First Name
+        last_name (String): Users Last Name
+
+    Returns:
+        list[string]: the base stems, before any numeric suffix
+    """
+    return [
+        first_name[0].lower() + last_name.lower(),
+        first_name.lower() + last_name[0].lower(),
+        first_name.lower() + last_name.lower()
+    ]
+
+def split_prefix(prefix):
+    """Splits a prefix into its stem and numeric suffix
+
+    Args:
+        prefix (string): an email prefix
+
+    Returns:
+        tuple[string, int]: the stem and suffix, 0 when there is no suffix
+    """
+    stem, suffix = SUFFIX_PATTERN.match(prefix).groups()
+    return stem, int(suffix) if suffix else 0
+
+class PrefixIndex:
+    """Set of used email prefixes, indexed by stem so a new prefix can be allocated
+    without scanning every existing one. Suffixes are always allocated above the
+    highest one in use for a stem, gaps left by removed accounts are not reused
+
+    Args:
+        prefixes (iterable[string]): prefixes that are already in use
+    """
+    def __init__(self, prefixes=()):
+        self._prefixes = set()
+        #stem -> suffixes in use, and the highest of them
+        self._suffixes = {}
+        self._highest = {}
+        self.update(prefixes)
+
+    def __contains__(self, prefix):
+        return prefix.lower() in self._prefixes
+
+    def __iter__(self):
+        return iter(self._prefixes)
+
+    def __len__(self):
+        return len(self._prefixes)
+
+    def add(self, prefix):
+        """Marks a prefix as used
+
+        Args:
+            prefix (string): the prefix to add
+        """
+        prefix = prefix.lower()
+        if prefix in self._prefixes:
+            return
+        self._prefixes.add(prefix)
+        stem, suffix = split_prefix(prefix)
+        self._suffixes.setdefault(stem, set()).add(suffix)
+        if suffix > self._highest.get(stem, -1):
+            self._highest[stem] = suffix
+
+    def update(self, prefixes):
+        """Marks several prefixes as used
+
+        Args:
+            prefixes (iterable[string]): the prefixes to add
+        """
+        for prefix in prefixes:
+            self.add(prefix)
+
+    def discard(self, prefix):
+        """Releases a prefix, if it is in use
+
+        Args:
+            prefix (string): the prefix to release
+        """
+        prefix = prefix.lower()
+        if prefix not in self._prefixes:
+            return
+        self._prefixes.remove(prefix)
+        stem, suffix = split_prefix(prefix)
+        suffixes = self._suffixes[stem]
+        suffixes.discard(suffix)
+        if not suffixes:
+            del self._suffixes[stem]
+            del self._highest[stem]
+        elif suffix == self._highest[stem]:
+            self._highest[stem] = max(suffixes)
+
+    def next_prefix(self, first_name, last_name):
+        """Finds the next unused prefix for a name, without reserving it
+
+        Args:
+            first_name (String): Users First Name
+            last_name (String): Users Last Name
+
+        Returns:
+            string: a new unique email prefix
+        """
+        stems = prefix_stems(first_name, last_name)
+        highest = [self._highest.get(stem, -1) for stem in stems]
+        suffix = min(highest) + 1
+        while True:
+            for stem, used in zip(stems, highest):
+                if used < suffix:
+                    candidate = stem + (str(suffix) if suffix else '')
+                    #stems that end in digits can hide under another stem, so confirm
+                    if candidate not in self._prefixes:
+                        return candidate
+            suffix += 1
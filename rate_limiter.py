@@ -0,0 +1,172 @@
+import threading
+import time
+
+#Statuses that mean Graph wants the client to slow down
+THROTTLE_STATUSES = (429, 503)
+
+def endpoint_class(method, url):
+    """Groups a Graph request into the class it is limited under
+
+    Args:
+        method (string): HTTP method
+        url (string): request url
+
+    Returns:
+        string: 'batch' for $batch envelopes, 'read' for GETs and 'write' for everything else
+    """
+    if url.rstrip('/').endswith('/$batch'):
+        return 'batch'
+    return 'read' if method.upper() == 'GET' else 'write'
+
+class AdaptiveLimiter:
+    """Token bucket with an AIMD concurrency limit for one endpoint class. Each success adds a little
+    to the allowed concurrency and request rate, while a 429 or a latency spike cuts them back
+    and a Retry-After pauses every caller in the class
+
+    Args:
+        name (string): the endpoint class
+        concurrency (int): requests allowed in flight at the start
+        max_concurrency (int): upper bound for requests in flight, usually the connection pool size
+        rate (float): requests per second allowed at the start
+        max_rate (float): upper bound for the request rate
+        latency_factor (float): latency, as a multiple of the fastest seen, that counts as congestion
+    """
+    def __init__(self, name, concurrency=4, max_concurrency=16, rate=50.0, max_rate=500.0, latency_factor=3.0):
+        self.name = name
+        self.limit = float(concurrency)
+        self.max_concurrency = max_concurrency
+        self.rate = float(rate)
+        self.max_rate = max_rate
+        self.latency_factor = latency_factor
+        self._cond = threading.Condition()
+        self.tokens = self.rate
+        self.refilled = time.monotonic()
+        self.active = 0
+        self.paused_until = 0
+        #cut back at most once per window, so one burst of 429s only halves the limit once
+        self.decrease_until = 0
+        self.min_latency = None
+        self.latency = None
+        self.completed = 0
+        self.throttled = 0
+        self.peak_limit = self.limit
+        self.first_start = None
+        self.last_end = None
+
+    def _refill(self, now):
+        #the bucket holds at most one second of requests
+        self.tokens = min(max(self.rate, 1.0), self.tokens + (now - self.refilled) * self.rate)
+        self.refilled = now
+
+    def acquire(self):
+        """Blocks until a request in this class may be sent"""
+        with self._cond:
+            while True:
+                now = time.monotonic()
+                self._refill(now)
+                if now < self.paused_until:
+                    wait = self.paused_until - now
+                elif self.active >= int(self.limit):
+                    wait = None
+                elif self.tokens < 1:
+                    wait = (1 - self.tokens) / self.rate
+                else:
+                    self.tokens -= 1
+                    self.active += 1
+                    if self.first_start is None:
+                        self.first_start = now
+                    return
+                self._cond.wait(wait)
+
+    def release(self, status, seconds, retry_after=None):
+        """Records how a request went and adjusts the limits
+
+        Args:
+            status (int): response status, None if the connection failed
+            seconds (float): time until the response arrived
+            retry_after (float): seconds Graph asked to wait, for throttled responses
+        """
+        with self._cond:
+            self.active -= 1
+            now = time.monotonic()
+            self.last_end = now
+            if status in THROTTLE_STATUSES:
+                self.throttled += 1
+                self._decrease(now, 0.5, retry_after or seconds)
+                if retry_after:
+                    self.paused_until = max(self.paused_until, now + retry_after)
+            elif status is not None and status < 500:
+                self.completed += 1
+                self.min_latency = seconds if self.min_latency is None else min(self.min_latency, seconds)
+                self.latency = seconds if self.latency is None else 0.8 * self.latency + 0.2 * seconds
+                if self.latency > self.latency_factor * max(self.min_latency, 0.01):
+                    #responses are slowing down, back off gently before Graph starts throttling
+                    self._decrease(now, 0.9, self.latency)
+                else:
+                    #additive increase, about one more request in flight per round trip
+                    self.limit = min(self.max_concurrency, self.limit + 1 / self.limit)
+                    self.rate = min(self.max_rate, self.rate + 1 / self.limit)
+                    self.peak_limit = max(self.peak_limit, self.limit)
+            self._cond.notify_all()
+
+    def _decrease(self, now, factor, window):
+        if now < self.decrease_until:
+            return
+        self.limit = max(1.0, self.limit * factor)
+        self.rate = max(1.0, self.rate * factor)
+        self.decrease_until = now + window
+
+    def pause(self, seconds):
+        """Holds every request in this class, used when a $batch sub-request is throttled
+
+        Args:
+            seconds (float): how long to pause
+        """
+        with self._cond:
+            now = time.monotonic()
+            self.throttled += 1
+            self._decrease(now, 0.5, seconds)
+            self.paused_until = max(self.paused_until, now + seconds)
+            self._cond.notify_all()
+
+    def stats(self):
+        """Reports the limits reached and the sustained rate
+
+        Returns:
+            dict: current concurrency and rate limits, peak concurrency, successes, throttles and sustained requests per second
+        """
+        with self._cond:
+            elapsed = (self.last_end - self.first_start) if self.first_start is not None and self.last_end is not None else 0
+            return {
+                'concurrency': round(self.limit, 2),
+                'peak_concurrency': round(self.peak_limit, 2),
+                'rate': round(self.rate, 2),
+                'completed': self.completed,
+                'throttled': self.throttled,
+                'sustained_rate': round(self.completed / elapsed, 2) if elapsed else None
+            }
+
+class RateController:
+    """One AdaptiveLimiter per endpoint class, created on first use
+
+    Args:
+        max_concurrency (int): upper bound for requests in flight per class
+        limiter_options (dict): other AdaptiveLimiter arguments
+    """
+    def __init__(self, max_concurrency=16, **limiter_options):
+        self.max_concurrency = max_concurrency
+        self.limiter_options = limiter_options
+        self.limiters = {}
+        self._lock = threading.Lock()
+
+    def limiter(self, method, url):
+        name = endpoint_class(method, url)
+        with self._lock:
+            if name not in self.limiters:
+                self.limiters[name] = AdaptiveLimiter(name, max_concurrency=self.max_concurrency, **self.limiter_options)
+            return self.limiters[name]
+
+    def stats(self):
+        with self._lock:
+            limiters = dict(self.limiters)
+        return {name: limiter.stats() for name, limiter in limiters.items()}
@@ -0,0 +1,77 @@
+from api_tools import get_all_users, batch_requests, batch_error, patch_user_request
+from user_resolution import office_attributes, ADDRESS_FIELDS
+from metrics import get_metrics
+
+#Properties pulled for every user, the ones reconcile can set plus the ids
+RECONCILE_FIELDS = ['id', 'userPrincipalName', 'officeLocation', *ADDRESS_FIELDS.values()]
+
+def diff_user(current, desired):
+    """Finds the fields where a user differs from their desired state. Empty strings count as unset
+
+    Args:
+        current (json): the user as returned by Graph
+        desired (dict): the fields the user should have
+
+    Returns:
+        dict: only the fields that need to change, with their desired values
+    """
+    return {field: value for field, value in desired.items() if (current.get(field) or None) != (value or None)}
+
+def plan_reconcile(users, location_df):
+    """Builds the minimal PATCH for every user whose address doesn't match their office in the Locations table
+
+    Args:
+        users (iterable[json]): directory users with the RECONCILE_FIELDS properties
+        location_df (DataFrame): Locations table
+
+    Returns:
+        tuple[list[tuple[json, dict]], int]: (user, changed fields) for each user that needs a PATCH,
+        and the number of users checked
+    """
+    offices = office_attributes(location_df)
+    changes = []
+    checked = 0
+    for user in users:
+        desired = offices.get(str(user.get('officeLocation') or '').lower())
+        if desired is None:
+            continue
+        checked += 1
+        fields = diff_user(user, desired)
+        if fields:
+            changes.append((user, fields))
+    return changes, checked
+
+def reconcile_users(access_token, location_df, dry_run=False, max_workers=8):
+    """Brings every directory user's address in line with the Locations table. Current state comes
+    from one projected paged pull and only the changed fields are sent, through $batch
+
+    Args:
+        access_token (string): access token for the MS Graph API
+        location_df (DataFrame): Locations table
+        dry_run (bool): print the changes without sending them
+        max_workers (int): number of $batch envelopes to send concurrently
+
+    Returns:
+        dict: counts of users checked, changed and failed
+    """
+    metrics = get_metrics()
+    with metrics.span('reconcile_plan'):
+        changes, checked = plan_reconcile(get_all_users(access_token, select=','.join(RECONCILE_FIELDS), max_workers=max_workers), location_df)
+    print(f"{len(changes)} of {checked} users in a known office need changes")
+    if dry_run:
+        for user, fields in changes:
+            print(f"{user['userPrincipalName']}: {fields}")
+        return {'checked': checked, 'changed': 0, 'failed': 0}
+
+    request_groups = [[patch_user_request(str(index), user['id'], **fields)] for index, (user, fields) in enumerate(changes)]
+    with metrics.span('reconcile_patch', items=len(request_groups)):
+        responses = batch_requests(access_token, request_groups, max_workers=max_workers)
+    failed = 0
+    for index, (user, fields) in enumerate(changes):
+        response = responses[str(index)]
+        if response['status'] == 204:
+            print(f"Updated {user['userPrincipalName']}: {', '.join(fields)}")
+        else:
+            failed += 1
+            print(f"Failed to update {user['userPrincipalName']}: {batch_error(response)}")
+    return {'checked': checked, 'changed': len(changes) - failed, 'failed': failed}
@@ -0,0 +1,88 @@
+from sql_queries import load_companies, load_department_names, load_locations, load_location_domains, table_signature
+import pandas as pd
+import time
+import json
+import os
+
+#Reference tables and the loaders that read them
+REFERENCE_TABLES = {
+    'Companies': load_companies,
+    'Departments': load_department_names,
+    'Locations': load_locations,
+    'Location_Domains': load_location_domains
+}
+MANIFEST_NAME = 'manifest.json'
+
+def load_manifest(cache_dir):
+    path = os.path.join(cache_dir, MANIFEST_NAME)
+    if not os.path.exists(path):
+        return {}
+    with open(path) as file:
+        return json.load(file)
+
+def save_manifest(cache_dir, manifest):
+    path = os.path.join(cache_dir, MANIFEST_NAME)
+    with open(path + '.tmp', 'w') as file:
+        json.dump(manifest, file)
+    os.replace(path + '.tmp', path)
+
+def load_scoped_reference(conn, scope):
+    """Loads only the reference rows a users file can match
+
+    Args:
+        conn (Engine): database engine
+        scope (dict): the companies, locations and departments returned by read_user_scope
+
+    Returns:
+        dict: table name mapped to what its loader returns
+    """
+    return {
+        'Companies': load_companies(conn, scope['companies']),
+        'Departments': load_department_names(conn, scope['departments']),
+        'Locations': load_locations(conn, scope['locations']),
+        'Location_Domains': load_location_domains(conn, scope['companies'], scope['locations'])
+    }
+
+def load_reference_data(conn, cache_dir=None, ttl=3600, scope=None):
+    """Loads the Companies, Departments, Locations and Location_Domains tables through a local snapshot.
+    Snapshots younger than the ttl are used without touching the database. Older ones are revalidated
+    with a per-table count/checksum query and only reloaded if the table changed
+
+    Args:
+        conn (Engine): database engine
+        cache_dir (string): folder for the snapshot files, None to always read the database
+        ttl (int): seconds a snapshot is trusted before it is revalidated
+        scope (dict): codes from read_user_scope, loads only the matching rows when there is no snapshot
+
+    Returns:
+        dict: table name mapped to what its loader returns
+    """
+    #a snapshot holds whole tables, so the scope only narrows direct database reads
+    if cache_dir is None and scope is not None:
+        return load_scoped_reference(conn, scope)
+    if cache_dir is None:
+        return {table: loader(conn) for table, loader in REFERENCE_TABLES.items()}
+
+    os.makedirs(cache_dir, exist_ok=True)
+    manifest = load_manifest(cache_dir)
+    now = time.time()
+    data = {}
+    for table, loader in REFERENCE_TABLES.items():
+        path = os.path.join(cache_dir, f"{table}.pkl")
+        entry = manifest.get(table)
+        cached = entry is not None and os.path.exists(path)
+        if cached and now - entry['validated'] < ttl:
+            data[table] = pd.read_pickle(path)
+            continue
+
+        signature = table_signature(conn, table)
+        if cached and entry['signature'] == signature:
+            data[table] = pd.read_pickle(path)
+        else:
+            print(f"Refreshing cached {table}")
+            data[table] = loader(conn)
+            pd.to_pickle(data[table], path)
+        manifest[table] = {'signature': signature, 'validated': now}
+
+    save_manifest(cache_dir, manifest)
+    return data
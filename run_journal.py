@@ -0,0 +1,106 @@
+import threading
+import time
+import json
+import os
+
+class RunJournal:
+    """Append-only record of the onboarding steps done for each user, so an interrupted run
+    can be resumed. Each line is a json object with the user key, the step and its data.
+    A 'released' step clears everything recorded for the user before it. The first line holds a digest
+    of the users file, so a journal is never applied to a different file. It holds plaintext passwords,
+    so it is only readable by this user and is removed once a run finishes cleanly
+
+    Steps: prefix_reserved, skipped, submitted, created, manager_set, license_assigned, released
+
+    Args:
+        journal_path (string): json lines file to append to, None to keep the journal in memory
+        source_digest (string): digest of the users file the journal is for, from file_digest
+
+    Raises:
+        Exception: if the journal was written for a different users file
+    """
+    def __init__(self, journal_path=None, source_digest=None):
+        self.journal_path = journal_path
+        self.source_digest = None
+        self._lock = threading.Lock()
+        #user key -> step -> data
+        self.state = {}
+        self._file = None
+        if journal_path is None:
+            return
+        if os.path.exists(journal_path):
+            with open(journal_path) as file:
+                for line in file:
+                    #a crash can leave a partial last line
+                    try:
+                        entry = json.loads(line)
+                    except json.JSONDecodeError:
+                        continue
+                    self._apply(entry)
+        #row keys only identify a row within one file, so another file's entries must never be applied
+        if self.state and self.source_digest != source_digest:
+            raise Exception(f"{journal_path} holds an unfinished run of a different users file, "
+                "finish that file or move the journal aside before onboarding this one")
+        descriptor = os.open(journal_path, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o600)
+        self._file = os.fdopen(descriptor, 'a')
+        if self.source_digest != source_digest:
+            self.record(None, 'source', digest=source_digest)
+
+    def _apply(self, entry):
+        key = entry.pop('key')
+        step = entry.pop('step')
+        if step == 'source':
+            self.source_digest = entry['digest']
+        elif step == 'released':
+            self.state.pop(key, None)
+        else:
+            self.state.setdefault(key, {})[step] = entry
+
+    def record(self, key, step, **data):
+        """Appends a step for a user and flushes it to disk
+
+        Args:
+            key (string): the user key
+            step (string): the step that was completed
+        """
+        entry = {'key': key, 'step': step, 'time': time.time(), **data}
+        with self._lock:
+            if self._file is not None:
+                self._file.write(json.dumps(entry) + '\n')
+                self._file.flush()
+            self._apply(entry)
+
+    def done(self, key, step):
+        """Checks if a step was recorded for a user
+
+        Args:
+            key (string): the user key
+            step (string): the step to check
+
+        Returns:
+            bool: True if the step is in the journal
+        """
+        return step in self.state.get(key, {})
+
+    def get(self, key, step):
+        """Gets the data recorded with a step
+
+        Args:
+            key (string): the user key
+            step (string): the step to look up
+
+        Returns:
+            dict: the step's data, None if it wasn't recorded
+        """
+        return self.state.get(key, {}).get(step)
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def finish(self):
+        """Closes the journal and removes it, once every user in the file reached their final step"""
+        self.close()
+        if self.journal_path is not None and os.path.exists(self.journal_path):
+            os.remove(self.journal_path)
@@ -1,86 +1,25 @@
-from api_tools import *
-from sql_queries import *
+from api_tools import (configure_session_from_env, get_session, configure_token_provider_from_env, get_user_prefixes, user_exists, find_existing_users,
+    print_json, batch_requests, batch_error, create_user_request, set_manager_request, assign_license_request)
+from sql_queries import load_existing_prefixes, loads_prefixes_by_stem, load_license_skus, ensure_prefix_index, reserve_prefixes, release_prefixes
+import pandas as pd
 import dotenv
 import os
 import string
 import random
-import struct
 import csv
-import pyodbc
-from sqlalchemy import create_engine
-import sqlite3
-import copy
-
-dotenv.load_dotenv()
-
-def pad_token(access_token):
-    """Pads MSAL access token for compatibility with MS SQL Server in Azure.
-    Further explanation of this issue can be found here.
-    https://github.com/AzureAD/azure-activedirectory-library-for-python/wiki/Connect-to-Azure-SQL-Database
-    https://github.com/mkleehammer/pyodbc/issues/228
-
-    Args:
-        access_token (string): Access Token returned by MSAL
-
-    Returns:
-        bytes: Byte packed access token
-    """
-    #Convert Token to Bytes
-    tokenb = bytes(access_token, "UTF-8")
-    exptoken = b''
-    for i in tokenb:
-        exptoken += bytes({i})
-        exptoken += bytes(1)
-    tokenstruct = struct.pack("=i", len(exptoken)) + exptoken
-    return tokenstruct
-
-def az_db_connect(driver,server,database,access_token):
-    """Establishes a connection to an Azure SQL database using an access token
-
-    Args:
-        driver (String): String describing the ODBC Driver to use for the connection
-        server (String): url and port for the SQL Server
-        database (database): Name of the Database to access on the SQL Server
-        access_token (string): access token to authenticate with the sql server
-
-    Returns:
-        _type_: _description_
-    """
-    #Build ODBC connection string
-    azure_conn_str = (
-    f"Driver={driver};"
-    f"Server={server};"
-    f"Database={database};"
-    )
-    
-    #Pad Token for compatibility
-    padded_token = pad_token(access_token)
-    SQL_COPT_SS_ACCESS_TOKEN = 1256
-    #Establish Connection
-    azure_conn = pyodbc.connect(azure_conn_str, attrs_before = { SQL_COPT_SS_ACCESS_TOKEN:padded_token })
-    engine= create_engine('mssql+pyodbc://',creator=lambda: azure_conn)
-    return engine
-
-def db_connect(access_token):
-    """ Establishes a connection to a database described in the environment
-
-    Args:
-        access_token (string): access token for Microsoft Graph
-
-    Raises:
-        Exception: Throws an exception if the Database type is invalid
-
-    Returns:
-        Connection: Database connection objects
-    """
-    mode = os.getenv("DB_MODE")
-    match mode:
-        case "SQLITE":
-            return sqlite3.connect(os.getenv("DB_PATH"))
-        case "AZURE":
-            return az_db_connect(os.getenv("DB_DRIVER"),os.getenv("DB_SERVER"),os.getenv("DB_DATABASE"),access_token)
-        case _:
-            raise Exception("Invalid Database Mode")
+from db import db_connect
+from prefix_index import PrefixIndex, prefix_stems
+from directory_sync import sync_user_prefixes
+from user_resolution import resolve_users
+from name_index import build_name_index
+from user_input import read_user_chunks, read_user_scope, file_digest
+from metrics import get_metrics, reset_metrics, profiled
+from reference_cache import load_reference_data
+from run_journal import RunJournal
+from manager_schedule import ManagerSchedule
+from licenses import load_sku_pool, shortage_message
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
 
 def prompt_user(question):
     """Prompts user for a yes or no question. Defaults to Yes if no input
@@ -140,149 +79,420 @@ def gen_prefix(first_name,last_name, existing_prefixes):
     Args:
         first_name (String): Users First Name
         last_name (String): Users Last Name
-        existing_prefixes (list): a list of prefixes that have already been used
+        existing_prefixes (PrefixIndex): index of prefixes that have already been used
 
     Returns:
         string: a new unique email prefix
     """
-    #define the 3 conventions: first initial last name, first name last initial, first name last name
-    pref_1 = lambda a,b,c : a[0].lower() + b.lower() + c
-    pref_2 = lambda a,b,c : a.lower() + b[0].lower() + c
-    pref_3 = lambda a,b,c : a.lower() + b.lower() + c
-    iter = ''
-
-    #iterate until unique prefix is found, then break
-    while True:
-        if (pref_1(first_name,last_name,iter)) not in existing_prefixes:
-            result = pref_1(first_name,last_name,iter)
-            break
-        elif (pref_2(first_name,last_name,iter)) not in existing_prefixes:
-            result = pref_2(first_name,last_name,iter)
-            break
-        elif (pref_3(first_name,last_name,iter)) not in existing_prefixes:
-            result = pref_3(first_name,last_name,iter)
-            break
-        elif iter == '':
-            #begin adding iterators after first loop
-            iter = '1'
-        else:
-            iter = str(int(iter)+1)
+    return existing_prefixes.next_prefix(first_name, last_name)
 
-    return result
+def user_key(index, args):
+    """Identifies a users file row across runs, by employee id or row number plus the name
 
-def iter_users(access_token, users_path, pass_path, prefixes, conn):
-    #read contents into pandas dataframes
-    user_df = pd.read_csv(users_path)
+    Args:
+        index (int): row number in the users file
+        args (dict): the row's Graph payload
 
-    dept_names = load_department_names(conn)
+    Returns:
+        string: the journal key for the row
+    """
+    ident = args.get('employeeId') or f"row{index}"
+    return f"{ident}:{args['givenName']}:{args['surname']}".lower()
 
-    company_df = load_companies(conn)
-    location_df = load_locations(conn)
-    loc_domain_df = load_location_domains(conn)
+def onboard_chunk(access_token, resolved, prefixes, pass_dict, conn, name_index=None, max_workers=8, journal=None, sku_pool=None,
+    confirm=None):
+    """Allocates prefixes, checks for duplicates, then creates and licenses the users in one resolved chunk.
+    Steps already recorded in the journal are skipped. Managers are linked afterwards by link_managers
 
-    pass_dict = {}
+    Args:
+        access_token (string): access token for the MS Graph API
+        resolved (DataFrame): users returned by resolve_users
+        prefixes (PrefixIndex): prefixes in use, updated with the created users
+        pass_dict (dict): password cache, updated with the created users
+        conn (Engine): database engine, prefixes are reserved in Existing_Prefixes as they are allocated
+        name_index (NameIndex): directory name index, built from the chunk's surnames if None
+        max_workers (int): number of Graph calls to run concurrently
+        journal (RunJournal): record of completed steps, in memory only if None
+        sku_pool (SkuPool): free license seats, None to skip license assignment
+        confirm (callable): asks whether to create a potential duplicate, prompt_user if None
 
-    for index, row in user_df.iterrows():
-        prefix = gen_prefix(row['firstName'], row['lastName'], prefixes)
+    Raises:
+        LicenseShortage: if the chunk needs more seats than are free, before anything is written
+    """
+    if journal is None:
+        journal = RunJournal()
+    confirm = confirm or prompt_user
+    metrics = get_metrics()
+    #reserved prefixes of users that were skipped or failed
+    released = []
+
+    users = []
+    for index, args, send_domain, _, sku in resolved.itertuples(index=False):
+        key = user_key(index, args)
+        if journal.done(key, 'skipped'):
+            continue
+        users.append({'index': index, 'key': key, 'args': args, 'domain': send_domain,
+            'sku': None if sku_pool is None or pd.isna(sku) else sku})
+
+    #Take the chunk's license seats up front, so a shortage stops it before any user is created
+    if sku_pool is not None:
+        sku_pool.reserve(Counter(user['sku'] for user in users if user['sku'] and not journal.done(user['key'], 'license_assigned')))
+
+    with metrics.span('allocate', items=len(users)):
+        #Pull only the database prefixes that can collide with this chunk's names
+        if loads_prefixes_by_stem(conn):
+            stems = {stem for user in users for stem in prefix_stems(user['args']['givenName'], user['args']['surname'])}
+            prefixes.update(load_existing_prefixes(conn, stems))
+        #Allocate prefixes on this thread only, so UPNs stay unique
+        for user in users:
+            #rows reserved on an earlier run keep their prefix
+            reserved = journal.get(user['key'], 'prefix_reserved')
+            user['prefix'] = reserved['prefix'] if reserved else gen_prefix(user['args']['givenName'], user['args']['surname'], prefixes)
+            user['new'] = reserved is None
+            #reserve the prefix now so later rows in the batch can't reuse it
+            prefixes.add(user['prefix'])
+
+        #Reserve the chunk's new prefixes in the database, moving any another run took to the next suffix
+        new_users = [user for user in users if user['new']]
+        conflicts = reserve_prefixes(conn, [user['prefix'] for user in new_users])
+        while conflicts:
+            retry = []
+            for user in new_users:
+                if user['prefix'] in conflicts:
+                    user['prefix'] = gen_prefix(user['args']['givenName'], user['args']['surname'], prefixes)
+                    prefixes.add(user['prefix'])
+                    retry.append(user['prefix'])
+            conflicts = reserve_prefixes(conn, retry)
+        for user in new_users:
+            journal.record(user['key'], 'prefix_reserved', prefix=user['prefix'])
+
+    for user in users:
         #Generate UPN
-        userPrincipalName = prefix + '@championsgh.com'
+        user['userPrincipalName'] = user['prefix'] + '@championsgh.com'
         #Generate Email Address
-        #Check if domain is determined by location
-        if row['companyAbbreviation'] in loc_domain_df['Company Abbreviation'].values:
-            send_domain = loc_domain_df.loc[loc_domain_df['Location Code'] == row['locationCode'], 'Domain'].values[0]
-        else:
-            #Assign domain based on company
-            send_domain = company_df.loc[company_df['Abbreviation'] == row['companyAbbreviation'], 'Domain'].values[0]
-        companyName = company_df.loc[company_df['Abbreviation'] == row['companyAbbreviation'], 'Name'].values[0]
-        #Set defaults for manager and licenses
-        manager = "NULL"
-
-        #Mandatory Fields: firstName, lastName, companyName        
-        args = {
-            'mailNickname': prefix,
-            'mail' : prefix + '@' + send_domain,
-            'givenName' : row['firstName'],
-            'surname' : row['lastName'],
-            'companyName' : companyName,
-            'accountEnabled': True
-        }
-        #Loop other values, skipping null
-        for column, value in row.items():
-            if str(value) != 'nan':
-                match column:
-                    case "firstName"|"lastName"|"companyAbbreviation":
-                        pass
-                    case "officePhone":
-                        args.update({'businessPhones' : [row[column]]})
-                    case "officeOrField":
-                        args.update({'onPremisesExtensionAttributes': {'extensionAttribute1':row['officeOrField']}})
-                    case "department":
-                        if row[column] not in dept_names:
-                            print("Invalid Department")
-                            return
-                        args.update({column: str(value)})
-                    case "locationCode":
-                        office_name = location_df.loc[location_df['Location Code'] == row[column], 'Office'].values[0]
-                        args.update({'officeLocation' : office_name, 
-                            'streetAddress': location_df.loc[location_df['Office'] == office_name, 'Address'].values[0],
-                            'city' : location_df.loc[location_df['Office'] == office_name, 'City'].values[0],
-                            'country' : location_df.loc[location_df['Office'] == office_name, 'Country'].values[0],
-                            'state' : location_df.loc[location_df['Office'] == office_name, 'State'].values[0],
-                            'postalCode' : str(location_df.loc[location_df['Office'] == office_name, 'Zip'].values[0])})
-                    case "manager":
-                        #cache manager value since its
-                        manager=row['manager']
-                    case _:
-                        args.update({column: str(value)})
-
-        #Get a list of users with the same first and last name
-        potential_dupes = get_users_by_name(access_token=access_token,firstName=args['givenName'],lastName=args['surname'])
-
+        user['args'] = {'mailNickname': user['prefix'], 'mail': user['prefix'] + '@' + user['domain'], **user['args']}
+
+    #Users sent on an earlier run that never recorded a result may have been created anyway
+    unconfirmed = [user for user in users if journal.done(user['key'], 'submitted') and not journal.done(user['key'], 'created')]
+    if unconfirmed:
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            found = list(executor.map(lambda user: user_exists(access_token, user['userPrincipalName']), unconfirmed))
+        for user, exists in zip(unconfirmed, found):
+            if exists:
+                password = journal.get(user['key'], 'submitted')['password']
+                journal.record(user['key'], 'created', userPrincipalName=user['userPrincipalName'], password=password)
+
+    #Index the directory users that could match this chunk, then check every row that was never sent
+    to_check = [user for user in users if not journal.done(user['key'], 'submitted')]
+    with metrics.span('duplicate_check', items=len(to_check)):
+        names = [(user['args']['givenName'], user['args']['surname']) for user in to_check]
+        if name_index is None and names:
+            name_index = build_name_index(access_token, names, max_workers=max_workers)
+        dupe_lists = [name_index.find(first_name, last_name) for first_name, last_name in names]
+
+    #Prompts, the password cache and the prefix list are only touched from this thread
+    for user, potential_dupes in zip(to_check, dupe_lists):
         #If there are potential duplicates, prompt the user if they are certain they want to create the account
         if len(potential_dupes) > 0:
             print("The following users may already exist:\n")
             print_json(potential_dupes)
-            if not prompt_user("Are you sure this isn't a duplicate? "):
-                print(f"Skipping User: {args['givenName']} {args['surname']}")
+            if not confirm("Are you sure this isn't a duplicate? "):
+                print(f"Skipping User: {user['args']['givenName']} {user['args']['surname']}")
+                prefixes.discard(user['prefix'])
+                released.append(user['prefix'])
+                if user['sku']:
+                    sku_pool.release(user['sku'])
+                journal.record(user['key'], 'skipped')
+                continue
+
+        #Generate the password and record it before the user is sent
+        journal.record(user['key'], 'submitted', password=gen_password())
+
+    request_groups = []
+    queued = []
+    for user in users:
+        key = user['key']
+        userPrincipalName = user['userPrincipalName']
+        if journal.done(key, 'skipped'):
+            continue
+        license_id = f"{user['index']}-license"
+        if journal.done(key, 'created'):
+            pass_dict.update({userPrincipalName:journal.get(key, 'created')['password']})
+            #Only the license is left for users created on an earlier run
+            if user['sku'] and not journal.done(key, 'license_assigned'):
+                request_groups.append([assign_license_request(license_id, userPrincipalName, sku_pool.sku_id(user['sku']))])
+                queued.append(user)
+            continue
+
+        create_id = f"{user['index']}-create"
+        group = [create_user_request(create_id, userPrincipalName, journal.get(key, 'submitted')['password'], **user['args'])]
+        #Assign the license once the create call has succeeded
+        if user['sku']:
+            group.append(assign_license_request(license_id, userPrincipalName, sku_pool.sku_id(user['sku']), depends_on=[create_id]))
+        request_groups.append(group)
+        queued.append(user)
+
+    #Send all writes through $batch and map the results back to each row, the licenses ride in the same envelopes
+    with metrics.span('create', items=len(queued)):
+        responses = batch_requests(access_token, request_groups, max_workers=max_workers)
+    for user in queued:
+        key = user['key']
+        userPrincipalName = user['userPrincipalName']
+        created = responses.get(f"{user['index']}-create")
+        if created is not None:
+            if created['status'] >= 500:
+                #Graph may have created the user before failing, a rerun checks with user_exists before sending it again
+                print(f"Create of {userPrincipalName} is unconfirmed: {batch_error(created)}")
+                continue
+            if created['status'] != 201:
+                print(f"Failed to create {userPrincipalName}: {batch_error(created)}")
+                #release the prefix so it isn't recorded as used, a rerun starts this user over
+                prefixes.discard(user['prefix'])
+                released.append(user['prefix'])
+                if user['sku']:
+                    sku_pool.release(user['sku'])
+                journal.record(key, 'released')
                 continue
+            print(f"Created {userPrincipalName}")
+            password = journal.get(key, 'submitted')['password']
+            journal.record(key, 'created', userPrincipalName=userPrincipalName, password=password)
+            pass_dict.update({userPrincipalName:password})
+        license_result = responses.get(f"{user['index']}-license")
+        if license_result is not None:
+            if license_result['status'] == 200:
+                journal.record(key, 'license_assigned', sku=user['sku'])
+            else:
+                print(f"Failed to assign {user['sku']} to {userPrincipalName}: {batch_error(license_result)}")
+                sku_pool.release(user['sku'])
+
+    if released:
+        release_prefixes(conn, released)
+
+def plan_managers(access_token, schedule, max_workers=8):
+    """Checks that every manager in the users file can be linked, before anything is written
+
+    Args:
+        access_token (string): access token for the MS Graph API
+        schedule (ManagerSchedule): the users file's manager graph
+        max_workers (int): number of lookups to run concurrently
+
+    Returns:
+        list[tuple[int, string]]: (row, message) for each unknown manager or manager cycle
+    """
+    return schedule.problems(find_existing_users(access_token, schedule.external_managers(), max_workers=max_workers))
+
+def link_managers(access_token, schedule, journal, max_workers=8):
+    """Sets the manager of every created user in one bulk phase, once all the creates are done,
+    so a manager that is a new hire exists whatever row they were on
 
-        #Generate the password and create the user
-        n_pass = gen_password()
-        create_user(access_token,userPrincipalName, n_pass, **args)        
-        prefixes.append(prefix)
-        pass_dict.update({userPrincipalName:n_pass})
+    Args:
+        access_token (string): access token for the MS Graph API
+        schedule (ManagerSchedule): the users file's manager graph
+        journal (RunJournal): record of completed steps, manager links are recorded in it
+        max_workers (int): number of $batch envelopes to send concurrently
+    """
+    levels, _ = schedule.levels()
+    request_groups = []
+    links = {}
+    for key in (key for level in levels for key in level):
+        manager = schedule.rows[key]['manager']
+        if not manager or not journal.done(key, 'created') or journal.done(key, 'manager_set'):
+            continue
+        userPrincipalName = journal.get(key, 'created')['userPrincipalName']
+        manager_key = schedule.manager_key(key)
+        if manager_key is not None:
+            #new hire managers are linked by the UPN they were just given
+            if not journal.done(manager_key, 'created'):
+                print(f"Skipping manager for {userPrincipalName}: {manager} was not created")
+                continue
+            manager = journal.get(manager_key, 'created')['userPrincipalName']
+        request_id = f"{schedule.rows[key]['index']}-manager"
+        request_groups.append([set_manager_request(request_id, userPrincipalName, manager)])
+        links[request_id] = (key, userPrincipalName)
+
+    with get_metrics().span('manager', items=len(request_groups)):
+        responses = batch_requests(access_token, request_groups, max_workers=max_workers)
+    for request_id, (key, userPrincipalName) in links.items():
+        response = responses[request_id]
+        if response['status'] == 204:
+            journal.record(key, 'manager_set')
+        else:
+            print(f"Failed to set manager for {userPrincipalName}: {batch_error(response)}")
 
-        #Set user manager
-        if(manager != "NULL"):
-            set_manager(access_token,userPrincipalName,manager)
+def iter_users(access_token, users_path, pass_path, prefixes, conn, max_workers=8, full_scan=False, fuzzy_threshold=None, chunk_size=500,
+    reference_cache_dir=None, reference_ttl=3600, journal_path=None, assign_licenses=False, reference=None, confirm=None):
+    """Validates a users file, then onboards it chunk by chunk and links the managers
 
-    dict_to_csv(pass_path, pass_dict)
+    Args:
+        access_token (string): access token for the MS Graph API
+        users_path (string): csv or json lines users file
+        pass_path (string): csv file the created users' passwords are written to
+        prefixes (PrefixIndex): prefixes in use, updated with the created users
+        conn (Engine): database engine
+        reference (dict): reference tables already in memory, loaded through the snapshot if None
+        confirm (callable): asks whether to create a potential duplicate, prompt_user if None
 
-def run():  
+    Returns:
+        dict: the created users' passwords, skipped user keys, invalid rows and any error that stopped the run
+    """
+    metrics = get_metrics()
+    result = {'created': {}, 'skipped': [], 'invalid': [], 'error': None}
+    with metrics.span('db_load'):
+        #reference tables come from the local snapshot when it is current
+        if reference is None:
+            #without a snapshot, read only the rows for the codes in the file
+            scope = read_user_scope(users_path, chunk_size) if reference_cache_dir is None else None
+            reference = load_reference_data(conn, reference_cache_dir, reference_ttl, scope=scope)
+        dept_names = reference['Departments']
+
+        company_df = reference['Companies']
+        location_df = reference['Locations']
+        loc_domain_df = reference['Location_Domains']
+        license_df = None
+        if assign_licenses:
+            license_df = reference['License_Skus'] if 'License_Skus' in reference else load_license_skus(conn)
+
+    #Seat counts are read once, then tracked locally as licenses are assigned
+    sku_pool = None
+    if assign_licenses:
+        with metrics.span('licenses'):
+            sku_pool = load_sku_pool(access_token)
+
+    #the journal lets a rerun of the same file pick up where this one stopped
+    journal = RunJournal(journal_path, source_digest=file_digest(users_path))
+
+    #Validate every chunk against the reference tables, and stop before any writes if a row is invalid
+    invalid = []
+    demand = Counter()
+    licensed = set()
+    schedule = ManagerSchedule()
+    for user_df in read_user_chunks(users_path, chunk_size):
+        with metrics.span('validate', items=len(user_df)):
+            resolved, chunk_invalid = resolve_users(user_df, company_df, location_df, loc_domain_df, dept_names, license_df)
+            invalid.extend(chunk_invalid)
+            for index, args, _, manager, _ in resolved.itertuples(index=False):
+                schedule.add(index, user_key(index, args), args.get('employeeId'), None if pd.isna(manager) else manager)
+            if sku_pool is not None:
+                for index, args, _, _, sku in resolved.itertuples(index=False):
+                    if pd.isna(sku):
+                        continue
+                    licensed.add(user_key(index, args))
+                    if journal.done(user_key(index, args), 'license_assigned'):
+                        continue
+                    if sku in sku_pool:
+                        demand[sku] += 1
+                    else:
+                        invalid.append((index, f"Unknown License SKU {sku}"))
+    #Managers must be in the directory already or be new hires in the file, without cycles
+    with metrics.span('manager_plan', items=len(schedule.rows)):
+        invalid.extend(plan_managers(access_token, schedule, max_workers=max_workers))
+    if invalid:
+        result['invalid'] = sorted(invalid)
+        for index, message in result['invalid']:
+            print(f"Row {index}: {message}")
+        journal.close()
+        return result
+    #Stop before any writes if the whole file needs more seats than are free
+    short = sku_pool.shortages(demand) if sku_pool is not None else {}
+    if short:
+        result['error'] = shortage_message(short)
+        print(result['error'])
+        journal.close()
+        return result
+
+    #a full scan or fuzzy matching needs the whole directory, so pull it once for every chunk
+    name_index = None
+    if full_scan or fuzzy_threshold is not None:
+        with metrics.span('duplicate_index'):
+            name_index = build_name_index(access_token, [], full_scan=True, fuzzy_threshold=fuzzy_threshold, max_workers=max_workers)
+
+    pass_dict = {}
+    try:
+        for user_df in read_user_chunks(users_path, chunk_size):
+            with metrics.span('resolve', items=len(user_df)):
+                resolved, _ = resolve_users(user_df, company_df, location_df, loc_domain_df, dept_names, license_df)
+            onboard_chunk(access_token, resolved, prefixes, pass_dict, conn, name_index=name_index, max_workers=max_workers,
+                journal=journal, sku_pool=sku_pool, confirm=confirm)
+        link_managers(access_token, schedule, journal, max_workers=max_workers)
+    finally:
+        journal.close()
+        dict_to_csv(pass_path, pass_dict)
+    #users that still have a step left are picked up by rerunning the same file
+    unfinished = [key for key, row in schedule.rows.items() if not journal.done(key, 'skipped') and not (journal.done(key, 'created')
+        and (not row['manager'] or journal.done(key, 'manager_set')) and (key not in licensed or journal.done(key, 'license_assigned')))]
+    if unfinished:
+        print(f"{len(unfinished)} users are unfinished, rerun the same users file to resume")
+    else:
+        #nothing is left to resume, so the journal and the passwords in it are removed
+        journal.finish()
+    result['created'] = pass_dict
+    result['skipped'] = [key for key in schedule.rows if journal.done(key, 'skipped')]
+    return result
+
+def run():
+    dotenv.load_dotenv()
+    metrics = reset_metrics()
+    try:
+        with profiled(os.getenv("PROFILE_PATH")):
+            onboard()
+    finally:
+        #a failed run is the one that most needs its metrics
+        print(metrics.summary())
+        print(f"Graph session: {get_session().stats()}")
+        if os.getenv("METRICS_PATH"):
+            metrics.write(os.getenv("METRICS_PATH"))
+
+def onboard_options_from_env():
+    """Reads the iter_users settings shared by every entry point from the environment
+
+    Returns:
+        dict: max_workers, full_scan, fuzzy_threshold, chunk_size and assign_licenses
+    """
+    return {
+        'max_workers': int(os.getenv("MAX_WORKERS", 8)),
+        'full_scan': os.getenv("DUPLICATE_FULL_SCAN", "").lower() == "true",
+        'fuzzy_threshold': float(os.getenv("DUPLICATE_FUZZY_THRESHOLD")) if os.getenv("DUPLICATE_FUZZY_THRESHOLD") else None,
+        'chunk_size': int(os.getenv("CHUNK_SIZE", 500)),
+        'assign_licenses': os.getenv("ASSIGN_LICENSES", "").lower() == "true"
+    }
+
+def connect():
+    """Sets up the Graph session, token provider and database pool described in the environment
+
+    Returns:
+        tuple[TokenProvider, string, Engine]: the token provider, a Graph access token and the database engine
+    """
+    #Share one pooled, retrying session across all Graph calls
+    configure_session_from_env()
     #Get Access Token for Graph API
-    client_secret=get_vault_secret(tenant_id=os.getenv("TENANT_ID"), vault_url=os.getenv("VAULT_URL"),secret_name=os.getenv("VAULT_SECRET_NAME"))
-    access_token = 'Bearer ' + get_access_token(os.getenv("CLIENT_ID"), os.getenv("AUTHORITY"),client_secret, [os.getenv("SCOPE")])
+    tokens = configure_token_provider_from_env()
+    access_token = 'Bearer ' + tokens.get_token([os.getenv("SCOPE")])
     #Get Access token for DB Access and establish connection
-    db_token=get_access_token(os.getenv("CLIENT_ID"), os.getenv("AUTHORITY"),client_secret, [os.getenv("DB_SCOPE")])
-    conn = db_connect(db_token)
-    #Load prefixes from db
-    prefixes = [item.lower() for item in load_existing_prefixes(conn)]
-    #create copy to diff later
-    old_prefixes = copy.deepcopy(prefixes)
-    #add prefixes from M365 and remove duplicates
-    prefixes += [item.lower() for item in get_user_prefixes(access_token)] 
-    #remove duplicates
-    uniq_prefixes = set(prefixes)
-    prefixes = list(uniq_prefixes)
-    
-    iter_users(access_token, os.getenv("USER_PATH"), os.getenv("PASS_PATH"), prefixes, conn)
-
-    new_prefixes = set(prefixes) - set(old_prefixes)
+    conn = db_connect(lambda: tokens.get_token([os.getenv("DB_SCOPE")]))
+    return tokens, access_token, conn
+
+def onboard():
+    metrics = get_metrics()
+    options = onboard_options_from_env()
+    with metrics.span('auth'):
+        _, access_token, conn = connect()
+    with metrics.span('prefix_load'):
+        #New prefixes are reserved in the db as they are allocated, guarded by a unique index
+        ensure_prefix_index(conn)
+        #Azure SQL prefixes are loaded per chunk for the stems that chunk needs, other databases load them all once
+        prefixes = PrefixIndex([] if loads_prefixes_by_stem(conn) else load_existing_prefixes(conn))
+        #add prefixes from M365, the index lowercases and removes duplicates
+        #use the local delta snapshot when one is configured, otherwise page the whole tenant one UPN range per worker
+        if os.getenv("PREFIX_SNAPSHOT_PATH"):
+            prefixes.update(sync_user_prefixes(access_token, os.getenv("PREFIX_SNAPSHOT_PATH")))
+        else:
+            prefixes.update(get_user_prefixes(access_token, max_workers=options['max_workers']))
 
-    # Identify new values
-    new_prefixes = [value for value in new_prefixes if value not in old_prefixes]
-    #Add new prefixes to database
-    new_pref_df = pd.DataFrame({'Prefix':new_prefixes})
-    new_pref_df.to_sql('Existing_Prefixes', conn, if_exists='append', index=False)
+    iter_users(access_token, os.getenv("USER_PATH"), os.getenv("PASS_PATH"), prefixes, conn,
+        reference_cache_dir=os.getenv("REFERENCE_CACHE_DIR"),
+        reference_ttl=int(os.getenv("REFERENCE_CACHE_TTL", 3600)),
+        journal_path=os.getenv("JOURNAL_PATH"),
+        **options)
 
-run()
+if __name__ == '__main__':
+    run()
@@ -1,36 +1,310 @@
-import pandas as pd
+import hashlib
 
-def load_companies(conn):
+#pandas and sqlalchemy are imported inside each query, so importing this module stays cheap
+#keep IN lists well under the 2100 parameter limit of SQL Server
+IN_LIST_LIMIT = 1000
+#LIKE patterns per prefix query, each one is a parameter
+LIKE_LIST_LIMIT = 200
+
+def read_in_list(conn, query, column, values):
+    """Runs a query filtered to the rows whose column is in a list of values, in chunks that fit the parameter limit
+
+    Args:
+        conn (Engine): database engine
+        query (string): query without a WHERE clause
+        column (string): column the values are matched against
+        values (list): values to match
+
+    Returns:
+        DataFrame: the rows of every chunk
+    """
+    import pandas as pd
+    from sqlalchemy import text, bindparam
+    statement = text(query + f"WHERE {column} IN :values").bindparams(bindparam('values', expanding=True))
+    values = sorted(set(values))
+    frames = [pd.read_sql(statement, conn, params={'values': values[i:i + IN_LIST_LIMIT]})
+        for i in range(0, max(len(values), 1), IN_LIST_LIMIT)]
+    return pd.concat(frames, ignore_index=True)
+
+def load_companies(conn, abbreviations=None):
+    """Loads the Companies table, or only the companies a batch uses
+
+    Args:
+        conn (Engine): database engine
+        abbreviations (list[string]): company abbreviations to load, None for every company
+
+    Returns:
+        DataFrame: Abbreviation, Name and Domain of each company
+    """
+    import pandas as pd
     query = f"""--sql
-        SELECT *
+        SELECT Abbreviation, Name, Domain
         FROM Companies
     """
-    return pd.read_sql(query, conn)
+    if abbreviations is None:
+        return pd.read_sql(query, conn)
+    return read_in_list(conn, query, "Abbreviation", abbreviations)
+
+def load_department_names(conn, names=None):
+    """Loads the valid department names, or only those a batch uses
+
+    Args:
+        conn (Engine): database engine
+        names (list[string]): department names to check, None for every department
 
-def load_department_names(conn):
+    Returns:
+        list[string]: the department names that exist
+    """
+    import pandas as pd
     query = f"""--sql
         SELECT Name
         FROM Departments
     """
-    return pd.read_sql(query, conn)['Name'].tolist()
+    if names is None:
+        return pd.read_sql(query, conn)['Name'].tolist()
+    return read_in_list(conn, query, "Name", names)['Name'].tolist()
+
+def like_pattern(stem):
+    """Escapes a stem for a LIKE 'stem%' match"""
+    for character in ('\\', '%', '_', '['):
+        stem = stem.replace(character, '\\' + character)
+    return stem + '%'
+
+def loads_prefixes_by_stem(conn):
+    """Tells whether prefixes are loaded per batch for its stems, or once for the whole run.
+    Azure SQL seeks LIKE 'stem%' on the unique Prefix index and its case insensitive collation
+    also matches prefixes stored in upper case. sqlite can't use the index for LIKE and only folds
+    ascii case, so there every prefix is loaded once and lowercased by PrefixIndex
+
+    Args:
+        conn (Engine): database engine
+
+    Returns:
+        bool: True if load_existing_prefixes should be called with each batch's stems
+    """
+    return conn.dialect.name == 'mssql'
+
+def load_existing_prefixes(conn, stems=None):
+    """Loads the prefixes in Existing_Prefixes, or only those starting with the given stems.
+    Each stem is a LIKE 'stem%' match, see loads_prefixes_by_stem for when to use it
 
-def load_existing_prefixes(conn):
+    Args:
+        conn (Engine): database engine
+        stems (list[string]): candidate stems for a batch, None for every prefix
+
+    Returns:
+        list[string]: the matching prefixes
+    """
+    import pandas as pd
+    from sqlalchemy import text
     query = f"""--sql
         SELECT Prefix
         FROM Existing_Prefixes
     """
-    return pd.read_sql(query,conn)['Prefix'].tolist()
+    if stems is None:
+        return pd.read_sql(query,conn)['Prefix'].tolist()
+    stems = sorted(set(stems))
+    prefixes = []
+    for i in range(0, len(stems), LIKE_LIST_LIMIT):
+        chunk = stems[i:i + LIKE_LIST_LIMIT]
+        clauses = ' OR '.join(f"Prefix LIKE :stem{n} ESCAPE '\\'" for n in range(len(chunk)))
+        params = {f"stem{n}": like_pattern(stem) for n, stem in enumerate(chunk)}
+        prefixes.extend(pd.read_sql(text(query + f"WHERE {clauses}"), conn, params=params)['Prefix'].tolist())
+    return prefixes
+
+def load_location_domains(conn, companies=None, location_codes=None):
+    """Loads the Location_Domains table, or only the rows a batch can use. A company's rows decide whether
+    its domain comes from the location, and a location's rows give the domain, so both are kept
+
+    Args:
+        conn (Engine): database engine
+        companies (list[string]): company abbreviations in the batch, None for every row
+        location_codes (list[string]): location codes in the batch, None for every row
 
-def load_location_domains(conn):
+    Returns:
+        DataFrame: Company Abbreviation, Location Code and Domain of each row
+    """
+    import pandas as pd
     query = f"""--sql
-        SELECT *
+        SELECT [Company Abbreviation], [Location Code], Domain
         FROM Location_Domains
     """
+    if companies is None or location_codes is None:
+        return pd.read_sql(query, conn)
+    rows = pd.concat([
+        read_in_list(conn, query, "[Company Abbreviation]", companies),
+        read_in_list(conn, query, "[Location Code]", location_codes)
+    ], ignore_index=True)
+    return rows.drop_duplicates(ignore_index=True)
+
+def load_locations(conn, location_codes=None):
+    """Loads the Locations table, or only the locations a batch uses
+
+    Args:
+        conn (Engine): database engine
+        location_codes (list[string]): location codes to load, None for every location
+
+    Returns:
+        DataFrame: Location Code, Office and the address columns of each location
+    """
+    import pandas as pd
+    query = f"""--sql
+        SELECT [Location Code], Office, Address, City, Country, State, Zip
+        FROM Locations
+    """
+    if location_codes is None:
+        return pd.read_sql(query, conn)
+    return read_in_list(conn, query, "[Location Code]", location_codes)
+
+def load_license_skus(conn):
+    import pandas as pd
+    query = f"""--sql
+        SELECT [Company Abbreviation], Department, [Sku Part Number]
+        FROM License_Skus
+    """
     return pd.read_sql(query, conn)
 
-def load_locations(conn):
+def table_signature(conn, table):
+    """Gets a fingerprint of a reference table that changes on any insert, update or delete,
+    used to tell if a cached copy is still current. Azure SQL uses the row count and an aggregate checksum.
+    sqlite has no row checksum, so its row count is paired with a hash of the rows, the reference tables are small
+
+    Args:
+        conn (Engine): database engine
+        table (string): name of a reference table
+
+    Returns:
+        list: the fingerprint values
+    """
+    from sqlalchemy import text
+    if conn.dialect.name == 'mssql':
+        query = f"""--sql
+            SELECT COUNT(*), CHECKSUM_AGG(BINARY_CHECKSUM(*))
+            FROM {table}
+        """
+        with conn.connect() as connection:
+            return list(connection.execute(text(query)).one())
+
     query = f"""--sql
         SELECT *
-        FROM Locations
+        FROM {table}
+        ORDER BY rowid
+    """
+    digest = hashlib.sha256()
+    count = 0
+    with conn.connect() as connection:
+        for row in connection.execute(text(query)):
+            digest.update(repr(tuple(row)).encode())
+            count += 1
+    return [count, digest.hexdigest()]
+
+def ensure_prefix_index(conn):
+    """Adds a unique index on Existing_Prefixes.Prefix if it is missing, so concurrent runs
+    can't reserve the same prefix
+
+    Args:
+        conn (Engine): database engine
+
+    Returns:
+        bool: True if the index exists, False if duplicate prefixes prevent creating it
+
+    Raises:
+        DBAPIError: if the index can't be created for any other reason
+    """
+    from sqlalchemy import text
+    from sqlalchemy.exc import DBAPIError, IntegrityError
+    if conn.dialect.name == 'mssql':
+        query = f"""--sql
+            IF NOT EXISTS (SELECT 1 FROM sys.indexes WHERE name = 'UX_Existing_Prefixes_Prefix')
+                CREATE UNIQUE INDEX UX_Existing_Prefixes_Prefix ON Existing_Prefixes (Prefix)
+        """
+    else:
+        query = f"""--sql
+            CREATE UNIQUE INDEX IF NOT EXISTS UX_Existing_Prefixes_Prefix ON Existing_Prefixes (Prefix)
+        """
+    try:
+        with conn.begin() as connection:
+            connection.execute(text(query))
+    except DBAPIError as error:
+        #only duplicate keys are expected, missing tables or permissions must stop the run
+        duplicates = isinstance(error, IntegrityError) or '1505' in str(error.orig) or 'UNIQUE constraint failed' in str(error.orig)
+        if not duplicates:
+            raise
+        print("Existing_Prefixes contains duplicate prefixes, concurrent runs are not protected from collisions")
+        return False
+    return True
+
+def find_existing_prefixes(connection, prefixes):
+    """Finds which of the given prefixes are already in Existing_Prefixes
+
+    Args:
+        connection (Connection): open database connection
+        prefixes (list[string]): prefixes to look up
+
+    Returns:
+        set[string]: the prefixes that are already used, lowercased
+    """
+    from sqlalchemy import text, bindparam
+    query = text(f"""--sql
+        SELECT Prefix
+        FROM Existing_Prefixes
+        WHERE Prefix IN :prefixes
+    """).bindparams(bindparam('prefixes', expanding=True))
+    taken = set()
+    for i in range(0, len(prefixes), IN_LIST_LIMIT):
+        rows = connection.execute(query, {'prefixes': prefixes[i:i + IN_LIST_LIMIT]})
+        taken.update(row[0].lower() for row in rows)
+    return taken
+
+def reserve_prefixes(conn, prefixes):
+    """Inserts prefixes into Existing_Prefixes in a single transaction. Prefixes another run
+    already holds are left out and returned, so the caller can allocate the next suffix
+
+    Args:
+        conn (Engine): database engine
+        prefixes (list[string]): prefixes to reserve
+
+    Returns:
+        set[string]: prefixes that could not be reserved
+
+    Raises:
+        IntegrityError: if an insert fails for a reason other than another run taking the prefix
+    """
+    from sqlalchemy import text
+    from sqlalchemy.exc import IntegrityError
+    if not prefixes:
+        return set()
+    query = text(f"""--sql
+        INSERT INTO Existing_Prefixes (Prefix)
+        VALUES (:prefix)
+    """)
+    while True:
+        try:
+            with conn.begin() as connection:
+                taken = find_existing_prefixes(connection, prefixes)
+                new_prefixes = [{'prefix': prefix} for prefix in prefixes if prefix not in taken]
+                if new_prefixes:
+                    connection.execute(query, new_prefixes)
+            return taken
+        except IntegrityError:
+            #another run inserted one of these between the check and the insert, check again.
+            #a race always takes another of our prefixes, if none was taken the error is something else
+            with conn.connect() as connection:
+                if find_existing_prefixes(connection, prefixes) <= taken:
+                    raise
+
+def release_prefixes(conn, prefixes):
+    """Removes reserved prefixes that ended up unused from Existing_Prefixes
+
+    Args:
+        conn (Engine): database engine
+        prefixes (list[string]): prefixes to release
     """
-    return pd.read_sql(query, conn)
\ No newline at end of file
+    from sqlalchemy import text, bindparam
+    query = text(f"""--sql
+        DELETE FROM Existing_Prefixes
+        WHERE Prefix IN :prefixes
+    """).bindparams(bindparam('prefixes', expanding=True))
+    with conn.begin() as connection:
+        for i in range(0, len(prefixes), IN_LIST_LIMIT):
+            connection.execute(query, {'prefixes': prefixes[i:i + IN_LIST_LIMIT]})
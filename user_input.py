@@ -0,0 +1,66 @@
+import hashlib
+import pandas as pd
+import os
+
+#Every users file column is read as text, so ids and phone numbers keep their exact form
+USER_COLUMNS = [
+    'lastName', 'firstName', 'displayName', 'officeOrField', 'officePhone', 'mobilePhone',
+    'locationCode', 'companyAbbreviation', 'department', 'jobTitle', 'employeeId', 'manager'
+]
+USER_DTYPES = {column: 'string' for column in USER_COLUMNS}
+
+def read_user_chunks(users_path, chunk_size=500):
+    """Streams a users file in fixed size chunks. Reads csv, or json lines for .jsonl/.json files.
+    Row labels keep counting across chunks, so they identify a row in the whole file
+
+    Args:
+        users_path (string): path to the users file
+        chunk_size (int): number of rows per chunk
+
+    Yields:
+        DataFrame: the next chunk of users, with text columns
+    """
+    extension = os.path.splitext(users_path)[1].lower()
+    if extension in ('.jsonl', '.json'):
+        reader = pd.read_json(users_path, lines=True, chunksize=chunk_size, dtype=USER_DTYPES)
+    else:
+        reader = pd.read_csv(users_path, chunksize=chunk_size, dtype=USER_DTYPES)
+    with reader:
+        for chunk in reader:
+            #json lines may leave out empty fields entirely
+            for column in USER_COLUMNS:
+                if column not in chunk:
+                    chunk[column] = pd.Series(pd.NA, index=chunk.index, dtype='string')
+            yield chunk
+
+def read_user_scope(users_path, chunk_size=500):
+    """Collects the reference codes a users file uses, so only those rows of the reference tables are loaded
+
+    Args:
+        users_path (string): path to the users file
+        chunk_size (int): number of rows per chunk
+
+    Returns:
+        dict: sets of the companies, locations and departments in the file
+    """
+    scope = {'companies': set(), 'locations': set(), 'departments': set()}
+    for chunk in read_user_chunks(users_path, chunk_size):
+        scope['companies'].update(chunk['companyAbbreviation'].dropna())
+        scope['locations'].update(chunk['locationCode'].dropna())
+        scope['departments'].update(chunk['department'].dropna())
+    return scope
+
+def file_digest(path):
+    """Hashes a file's contents, used to tie a run journal to the users file it was written for
+
+    Args:
+        path (string): path to the file
+
+    Returns:
+        string: sha256 hex digest of the file
+    """
+    digest = hashlib.sha256()
+    with open(path, 'rb') as file:
+        for block in iter(lambda: file.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
@@ -0,0 +1,151 @@
+from licenses import resolve_skus
+import pandas as pd
+
+#Locations columns copied onto the user, keyed by office
+ADDRESS_FIELDS = {
+    'Address': 'streetAddress',
+    'City': 'city',
+    'Country': 'country',
+    'State': 'state',
+    'Zip': 'postalCode'
+}
+
+def as_key(series):
+    """Casts a join column to object so empty (float) columns still merge with text keys"""
+    return series.astype(object)
+
+def address_value(value):
+    """Formats a Locations address value for Graph. Whole number floats, such as a zip code read
+    from a column with gaps, lose their '.0'
+
+    Args:
+        value: the value from the Locations table
+
+    Returns:
+        string: the formatted value, None if it is empty
+    """
+    if pd.isna(value):
+        return None
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return str(value)
+
+def office_attributes(location_df):
+    """Maps each office to the address fields a user in that office gets
+
+    Args:
+        location_df (DataFrame): Locations table
+
+    Returns:
+        dict: lowercased office name mapped to its Graph address fields
+    """
+    offices = {}
+    for record in location_df.drop_duplicates('Office').to_dict('records'):
+        fields = {field: address_value(record[column]) for column, field in ADDRESS_FIELDS.items()}
+        offices[str(record['Office']).lower()] = {'officeLocation': record['Office'], **fields}
+    return offices
+
+def build_payload(record, columns, offices):
+    """Builds the Graph payload for one resolved user, without the prefix dependent fields
+
+    Args:
+        record (dict): the user's row joined with its reference data
+        columns (list[string]): the columns from the users file
+        offices (dict): office address fields from office_attributes
+
+    Returns:
+        dict: payload for create_user
+    """
+    #Mandatory Fields: firstName, lastName, companyName
+    args = {
+        'givenName' : record['firstName'],
+        'surname' : record['lastName'],
+        'companyName' : record['_companyName'],
+        'accountEnabled': True
+    }
+    #Loop other values, skipping null
+    for column in columns:
+        value = record[column]
+        if pd.isna(value):
+            continue
+        match column:
+            case "firstName"|"lastName"|"companyAbbreviation"|"manager":
+                pass
+            case "officePhone":
+                args.update({'businessPhones' : [value]})
+            case "officeOrField":
+                args.update({'onPremisesExtensionAttributes': {'extensionAttribute1':value}})
+            case "locationCode":
+                #the same office mapping reconcile applies, so both always send the same fields
+                if not pd.isna(record['_office']):
+                    args.update(offices[str(record['_office']).lower()])
+            case _:
+                args.update({column: str(value)})
+    return args
+
+def resolve_users(user_df, company_df, location_df, loc_domain_df, dept_names, license_df=None):
+    """Joins every user with the reference tables at once and builds their Graph payloads
+
+    Args:
+        user_df (DataFrame): users read from the users file
+        company_df (DataFrame): Companies table
+        location_df (DataFrame): Locations table
+        loc_domain_df (DataFrame): Location_Domains table
+        dept_names (list[string]): valid department names
+        license_df (DataFrame): License_Skus table, None to skip license resolution
+
+    Returns:
+        tuple[DataFrame, list]: resolved users (row, payload, domain, manager, sku), and
+        (row, message) for each row with an unknown company, location or department
+    """
+    df = user_df.rename_axis('row').reset_index()
+    df['_companyKey'] = as_key(df['companyAbbreviation'])
+    df['_locationKey'] = as_key(df['locationCode'])
+
+    companies = pd.DataFrame({
+        '_companyKey': as_key(company_df['Abbreviation']),
+        '_companyName': company_df['Name'],
+        '_companyDomain': company_df['Domain']
+    }).drop_duplicates('_companyKey')
+    df = df.merge(companies, on='_companyKey', how='left')
+
+    #a location code resolves to an office, and the address fields come from that office in build_payload
+    offices = pd.DataFrame({
+        '_locationKey': as_key(location_df['Location Code']),
+        '_office': location_df['Office']
+    }).drop_duplicates('_locationKey')
+    df = df.merge(offices, on='_locationKey', how='left')
+
+    loc_domains = pd.DataFrame({
+        '_locationKey': as_key(loc_domain_df['Location Code']),
+        '_locationDomain': loc_domain_df['Domain']
+    }).drop_duplicates('_locationKey')
+    df = df.merge(loc_domains, on='_locationKey', how='left')
+
+    #Check if domain is determined by location, otherwise assign domain based on company
+    by_location = df['companyAbbreviation'].isin(loc_domain_df['Company Abbreviation'])
+    df['domain'] = df['_locationDomain'].where(by_location, df['_companyDomain'])
+
+    #Collect every invalid row up front
+    checks = [
+        (df['_companyName'].isna(), 'Invalid Company'),
+        (df['locationCode'].notna() & df['_office'].isna(), 'Invalid Location'),
+        (df['department'].notna() & ~df['department'].isin(dept_names), 'Invalid Department'),
+        (df['_companyName'].notna() & df['domain'].isna(), 'No Mail Domain')
+    ]
+    invalid = []
+    for mask, message in checks:
+        invalid.extend((row, message) for row in df.loc[mask, 'row'])
+    invalid.sort()
+
+    columns = list(user_df.columns)
+    office_fields = office_attributes(location_df)
+    resolved = pd.DataFrame({
+        'row': df['row'],
+        'payload': [build_payload(record, columns, office_fields) for record in df.to_dict('records')],
+        'domain': df['domain'],
+        'manager': df['manager'] if 'manager' in df else None,
+        'sku': resolve_skus(df, license_df) if license_df is not None else None
+    })
+    resolved = resolved[~resolved['row'].isin([row for row, _ in invalid])]
+    return resolved, invalid
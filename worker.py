@@ -0,0 +1,184 @@
+from api_tools import get_user_prefix_delta, DeltaExpired
+from sql_queries import ensure_prefix_index, load_existing_prefixes, loads_prefixes_by_stem, load_license_skus
+from directory_sync import sync_user_prefixes, load_snapshot
+from reference_cache import load_reference_data
+from prefix_index import PrefixIndex
+from metrics import reset_metrics
+import simple_gen
+import traceback
+import time
+import json
+import os
+
+#Users files picked up from the drop folder
+JOB_EXTENSIONS = ('.csv', '.jsonl', '.json')
+
+class Worker:
+    """Onboards users files dropped into a folder, one job per file. Tokens, the database pool,
+    the prefix index and the reference tables stay in memory between jobs, so a small batch only pays
+    for a delta query and its own writes
+
+    A job is moved to processing/ while it runs and then to done/ or failed/. Each job gets a
+    <name>.result.json and a <name>.passwords.csv in results/, plus a <name>.journal.jsonl until every user is finished. Jobs left in
+    processing/ by a stopped worker are resumed from their journal on the next start
+
+    Args:
+        drop_dir (string): folder watched for csv or json lines users files
+        token_source (callable): function returning a Graph bearer token
+        conn (Engine): database engine
+        prefix_snapshot_path (string): prefix snapshot to start from, None to pull every prefix on start
+        reference_cache_dir (string): folder for the reference table snapshot
+        reference_ttl (int): seconds the in-memory reference tables are used before they are revalidated
+        onboard_options (dict): extra iter_users arguments, such as max_workers or assign_licenses
+        settle_seconds (float): how long a file must go unmodified before it is picked up, so half copied files are left alone
+    """
+    def __init__(self, drop_dir, token_source, conn, prefix_snapshot_path=None, reference_cache_dir=None, reference_ttl=3600,
+        onboard_options=None, settle_seconds=2):
+        self.drop_dir = drop_dir
+        self.token_source = token_source
+        self.conn = conn
+        self.prefix_snapshot_path = prefix_snapshot_path
+        self.reference_cache_dir = reference_cache_dir
+        self.reference_ttl = reference_ttl
+        self.onboard_options = onboard_options or {}
+        self.settle_seconds = settle_seconds
+        self.folders = {name: os.path.join(drop_dir, name) for name in ('processing', 'done', 'failed', 'results')}
+        for folder in self.folders.values():
+            os.makedirs(folder, exist_ok=True)
+        self.prefixes = None
+        self.delta_link = None
+        self.reference = None
+        self.reference_loaded = 0
+
+    def start(self):
+        """Loads the prefix index and reference tables that are kept warm between jobs"""
+        access_token = self.token_source()
+        ensure_prefix_index(self.conn)
+        #Azure SQL prefixes are loaded by each job for the stems it needs, other databases load them all once
+        self.prefixes = PrefixIndex([] if loads_prefixes_by_stem(self.conn) else load_existing_prefixes(self.conn))
+        if self.prefix_snapshot_path:
+            self.prefixes.update(sync_user_prefixes(access_token, self.prefix_snapshot_path))
+            self.delta_link = load_snapshot(self.prefix_snapshot_path)['deltaLink']
+        else:
+            changes, self.delta_link = get_user_prefix_delta(access_token)
+            self.prefixes.update(prefix for prefix in changes.values() if prefix)
+        self.load_reference()
+
+    def load_reference(self):
+        self.reference = load_reference_data(self.conn, self.reference_cache_dir, self.reference_ttl)
+        if self.onboard_options.get('assign_licenses'):
+            self.reference['License_Skus'] = load_license_skus(self.conn)
+        self.reference_loaded = time.time()
+
+    def refresh(self, access_token):
+        """Catches the warm state up with changes made since the last job
+
+        Args:
+            access_token (string): access token for the MS Graph API
+        """
+        try:
+            changes, self.delta_link = get_user_prefix_delta(access_token, self.delta_link)
+        except DeltaExpired:
+            changes, self.delta_link = get_user_prefix_delta(access_token)
+        #prefixes of deleted users stay taken, so they are never handed out again.
+        #prefixes other runs reserved since the last job are caught when this job reserves its own
+        self.prefixes.update(prefix for prefix in changes.values() if prefix)
+        if time.time() - self.reference_loaded >= self.reference_ttl:
+            self.load_reference()
+
+    def next_job(self):
+        """Claims the oldest users file in the drop folder
+
+        Returns:
+            string: path of the claimed file in processing/, None if the folder is empty
+        """
+        settled = time.time() - self.settle_seconds
+        jobs = []
+        for name in os.listdir(self.drop_dir):
+            source = os.path.join(self.drop_dir, name)
+            if name.lower().endswith(JOB_EXTENSIONS) and os.path.isfile(source) and os.path.getmtime(source) <= settled:
+                jobs.append((os.path.getmtime(source), name))
+        for _, name in sorted(jobs):
+            #the claim time keeps result files apart when HR reuses a file name
+            path = os.path.join(self.folders['processing'], time.strftime('%Y%m%d-%H%M%S-') + name)
+            try:
+                os.replace(os.path.join(self.drop_dir, name), path)
+            except FileNotFoundError:
+                #another worker claimed it first
+                continue
+            return path
+        return None
+
+    def run_job(self, path):
+        """Onboards one claimed users file and writes its result file
+
+        Args:
+            path (string): the users file in processing/
+
+        Returns:
+            dict: the job result
+        """
+        name = os.path.basename(path)
+        stem = os.path.splitext(name)[0]
+        results = self.folders['results']
+        metrics = reset_metrics()
+        started = time.time()
+        result = {'job': name, 'started': started}
+        try:
+            access_token = self.token_source()
+            with metrics.span('refresh'):
+                self.refresh(access_token)
+            #nobody is there to answer prompts, potential duplicates are skipped and listed in the result
+            outcome = simple_gen.iter_users(access_token, path, os.path.join(results, stem + '.passwords.csv'), self.prefixes, self.conn,
+                journal_path=os.path.join(results, stem + '.journal.jsonl'), reference=self.reference, confirm=lambda question: False,
+                **self.onboard_options)
+            result['status'] = 'invalid' if outcome['invalid'] or outcome['error'] else 'done'
+            result['created'] = sorted(outcome['created'])
+            result['skipped'] = outcome['skipped']
+            result['invalid'] = [{'row': int(row), 'message': message} for row, message in outcome['invalid']]
+            result['error'] = outcome['error']
+        except Exception as error:
+            traceback.print_exc()
+            result['status'] = 'failed'
+            result['error'] = f"{type(error).__name__}: {error}"
+        result['seconds'] = time.time() - started
+        result['metrics'] = metrics.to_dict()['spans']
+
+        with open(os.path.join(results, stem + '.result.json'), 'w') as file:
+            json.dump(result, file, indent=2)
+        os.replace(path, os.path.join(self.folders['done' if result['status'] == 'done' else 'failed'], name))
+        print(f"{name}: {result['status']}, {len(result.get('created', []))} created in {result['seconds']:.1f}s")
+        return result
+
+    def resume(self):
+        """Finishes the jobs a stopped worker left in processing/, each picks up from its journal
+
+        Returns:
+            list[dict]: the job results
+        """
+        return [self.run_job(os.path.join(self.folders['processing'], name)) for name in sorted(os.listdir(self.folders['processing']))]
+
+    def run_pending(self):
+        """Runs every job waiting in the drop folder
+
+        Returns:
+            list[dict]: the job results
+        """
+        results = []
+        path = self.next_job()
+        while path is not None:
+            results.append(self.run_job(path))
+            path = self.next_job()
+        return results
+
+    def run_forever(self, poll_seconds=5):
+        """Watches the drop folder until interrupted
+
+        Args:
+            poll_seconds (float): seconds to wait between checks of an empty folder
+        """
+        self.resume()
+        print(f"Watching {self.drop_dir} for users files")
+        while True:
+            if not self.run_pending():
+                time.sleep(poll_seconds)